@@ -0,0 +1,258 @@
+import argparse
+import csv
+import io
+import json
+import logging
+import os
+import platform
+import random
+import subprocess
+import sys
+import tempfile
+import time
+import timeit
+import uuid
+from collections import deque
+from typing import Callable, Dict, List, Optional, TypeVar
+
+from wedding.model import EmailAddress, Guest, NotInvited, Party
+
+from import_addresses import INVITER_MAP, parse_parties, read_addresses, write_party_json
+from invites.model import Invitation, InvitationRenderer, build_invitations
+from invites.render import EnvelopeRenderer, MessageBuilder, base64_email, email_address
+
+
+SENDER = EmailAddress('sender', 'example.com')
+
+INVITATION_URL = 'https://example.com/invitation?party={partyId}&guest={guestId}'
+ENVELOPE_URL   = 'https://example.com/envelopes/{partyId}.png'
+
+T = TypeVar('T')
+
+_FIRST_NAMES = ['Jenny', 'Jesse', 'Ana', 'Bo', 'Chloé', 'Dmitri', 'Eve', 'Femi', 'Gus', 'Hana']
+_LAST_NAMES  = ['Kelly', 'Rosenberger', 'Smith', "O'Brien", 'García', 'Nguyen', 'Park', 'Ivanova']
+
+
+def _invitation(body_file: str) -> Invitation:
+    with open(body_file, 'r') as fin:
+        return Invitation(
+            EmailAddress('guest', 'example.com'),
+            'Jenny and Jesse are Getting Married!',
+            fin.read(),
+            'guest'
+        )
+
+
+def _per_call(function, repeat: int, number: int) -> float:
+    return min(timeit.repeat(function, repeat = repeat, number = number)) / number
+
+
+def bench_messages(body_file: str, repeat: int, number: int) -> None:
+    invitation    = _invitation(body_file)
+    build_message = MessageBuilder(SENDER)
+
+    before = _per_call(lambda: base64_email(SENDER, invitation), repeat, number)
+    after  = _per_call(lambda: build_message(invitation), repeat, number)
+
+    print(f'base64_email  : {before * 1e6:8.1f} us/message')
+    print(f'MessageBuilder: {after * 1e6:8.1f} us/message ({before / after:.1f}x)')
+
+
+# Parties of one to four guests, with roughly one guest in ten lacking an
+# email address, seeded so every run and commit sees the same data.
+def synthetic_parties(guests: int, seed: int = 0) -> List[Party]:
+    rng     = random.Random(seed)
+    parties = []  # type: List[Party]
+    created = 0
+
+    while created < guests:
+        size = min(rng.randint(1, 4), guests - created)
+        last = rng.choice(_LAST_NAMES)
+        parties.append(Party(
+            id     = str(uuid.UUID(int = rng.getrandbits(128))),
+            title  = f'The {last} Family {len(parties)}',
+            local  = rng.random() < 0.5,
+            guests = [
+                Guest(
+                    id         = str(uuid.UUID(int = rng.getrandbits(128))),
+                    first_name = rng.choice(_FIRST_NAMES),
+                    last_name  = last,
+                    email      = None if rng.random() < 0.1 else EmailAddress(f'guest{created + i}', 'example.com'),
+                    attending  = None,
+                    rideshare  = None
+                )
+                for i in range(size)
+            ],
+            inviter    = rng.choice(sorted(INVITER_MAP.values())),
+            rsvp_stage = NotInvited
+        ))
+        created += size
+
+    return parties
+
+
+def write_address_file(parties: List[Party], filename: str) -> None:
+    inviters = { address: name for name, address in INVITER_MAP.items() }
+    with open(filename, 'w', newline = '') as fout:
+        writer = csv.writer(fout)
+        writer.writerow(['Title', 'First', 'Last', 'Email', 'Local', 'Inviter'])
+        for party in parties:
+            for guest in party.guests:
+                writer.writerow([
+                    party.title,
+                    guest.first_name,
+                    guest.last_name,
+                    '' if guest.email is None else email_address(guest.email),
+                    'true' if party.local else 'false',
+                    inviters[party.inviter]
+                ])
+
+
+def _consume(iterable) -> None:
+    deque(iterable, maxlen = 0)
+
+
+# Calls make once, on first use, and returns its result from then on.
+def _once(make: Callable[[], T]) -> Callable[[], T]:
+    result = []  # type: List[T]
+
+    def get() -> T:
+        if not result:
+            result.append(make())
+        return result[0]
+    return get
+
+
+# Every benchmark, as a function that prepares its inputs and returns the
+# call to time. Inputs are only built for the benchmarks that are run, and
+# only once for the benchmarks that share them.
+def _benchmarks(parties: List[Party],
+                body_template: str,
+                scratch_dir: str) -> Dict[str, Callable[[], Callable[[], None]]]:
+    json_file = os.path.join(scratch_dir, 'parties.json')
+
+    def make_address_file() -> str:
+        address_file = os.path.join(scratch_dir, 'addresses.csv')
+        write_address_file(parties, address_file)
+        return address_file
+
+    address_file       = _once(make_address_file)
+    render_invitations = _once(lambda: InvitationRenderer(INVITATION_URL, body_template, ENVELOPE_URL))
+    invitations        = _once(lambda: [
+        invitation
+        for party in parties
+        for invitation in render_invitations()(party)
+    ])
+
+    def bench_base64_email() -> Callable[[], None]:
+        messages = invitations()
+        return lambda: _consume(base64_email(SENDER, invitation) for invitation in messages)
+
+    def bench_message_builder() -> Callable[[], None]:
+        messages, build_message = invitations(), MessageBuilder(SENDER)
+        return lambda: _consume(build_message(invitation) for invitation in messages)
+
+    def bench_read_addresses() -> Callable[[], None]:
+        addresses = address_file()
+        return lambda: _consume(read_addresses(addresses))
+
+    def bench_parse_parties() -> Callable[[], None]:
+        addresses = address_file()
+        return lambda: _consume(parse_parties(read_addresses(addresses), errors = []))
+
+    def bench_invitation_renderer() -> Callable[[], None]:
+        render = render_invitations()
+        return lambda: _consume(render.render_all(parties))
+
+    return {
+        'build_invitations': lambda: lambda: _consume(
+            invitation
+            for party in parties
+            for invitation in build_invitations(INVITATION_URL, body_template, ENVELOPE_URL, party)
+        ),
+        'InvitationRenderer': bench_invitation_renderer,
+        'base64_email': bench_base64_email,
+        'MessageBuilder': bench_message_builder,
+        'write_recipients_file': lambda: lambda: EnvelopeRenderer.write_recipients_file(parties, io.StringIO()),
+        'read_addresses': bench_read_addresses,
+        'read_addresses+parse_parties': bench_parse_parties,
+        'write_party_json': lambda: lambda: write_party_json(json_file, parties)
+    }
+
+
+def _commit() -> Optional[str]:
+    try:
+        return subprocess.check_output(
+            ['git', 'rev-parse', 'HEAD'],
+            cwd    = os.path.dirname(os.path.abspath(__file__)),
+            stderr = subprocess.DEVNULL
+        ).decode('ascii').strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+
+# Times every benchmark at every scale, keeping the best of `repeat` runs,
+# and returns the results in a form that can be diffed between commits.
+def bench_suite(body_file: str,
+                scales: List[int],
+                repeat: int,
+                only: List[str]) -> dict:
+    with open(body_file, 'r') as fin:
+        body_template = fin.read()
+
+    results = []
+    for guests in scales:
+        parties = synthetic_parties(guests)
+        with tempfile.TemporaryDirectory() as scratch_dir:
+            for name, prepare in _benchmarks(parties, body_template, scratch_dir).items():
+                if only and name not in only:
+                    continue
+                seconds = min(timeit.repeat(prepare(), repeat = repeat, number = 1))
+                print(f'{name:30} {guests:>7} guests: {seconds:10.4f} s  {seconds / guests * 1e6:10.2f} us/guest', file = sys.stderr)
+                results.append({
+                    'benchmark'   : name,
+                    'guests'      : guests,
+                    'parties'     : len(parties),
+                    'seconds'     : seconds,
+                    'us_per_guest': seconds / guests * 1e6
+                })
+
+    return {
+        'commit'   : _commit(),
+        'python'   : platform.python_version(),
+        'platform' : platform.platform(),
+        'timestamp': time.strftime('%Y-%m-%dT%H:%M:%S'),
+        'repeat'   : repeat,
+        'results'  : results
+    }
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--body-file', default = 'resources/email_template.html')
+    parser.add_argument('--repeat', type = int, default = 5)
+    parser.add_argument('--number', type = int, default = 1000)
+    parser.add_argument('--messages', action = 'store_true',
+                        help = 'Only compare base64_email with MessageBuilder on a single message')
+    parser.add_argument('--guests', type = int, nargs = '+', default = [1000, 10000],
+                        help = 'Numbers of synthetic guests to run every benchmark at, e.g. 1000 10000 100000')
+    parser.add_argument('--only', nargs = '+', default = [],
+                        help = 'Names of the benchmarks to run; all of them by default. build_invitations inlines CSS per guest and takes minutes at 100000 guests')
+    parser.add_argument('--output',
+                        help = 'File to write the JSON results to; standard output by default')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    args = parse_arguments()
+    # premailer warns about every vendor-prefixed CSS property it inlines.
+    logging.disable(logging.WARNING)
+    if args.messages:
+        bench_messages(args.body_file, args.repeat, args.number)
+    else:
+        report = json.dumps(bench_suite(args.body_file, args.guests, args.repeat, args.only), indent = 2)
+        if args.output is None:
+            print(report)
+        else:
+            with open(args.output, 'w') as fout:
+                fout.write(report + '\n')
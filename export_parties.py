@@ -0,0 +1,24 @@
+import argparse
+
+import boto3
+from wedding.model import party_store
+
+from invites.snapshot import write_snapshot
+
+
+def main(args):
+    parties = party_store(boto3.resource('dynamodb').Table(args.parties_table)).get_all()
+    count   = write_snapshot(args.output, parties)
+    print(f'Wrote {count} parties from {args.parties_table} to {args.output}')
+
+
+def parse_arguments():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('--parties-table', required = True)
+    parser.add_argument('--output', default = 'parties.jsonl.gz',
+                        help = 'Snapshot file to write; its index is written next to it with an .index suffix')
+    return parser.parse_args()
+
+
+if __name__ == '__main__':
+    main(parse_arguments())
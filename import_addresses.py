@@ -1,18 +1,24 @@
 import argparse
 import csv
 import json
+import os
+import re
 import uuid
-from typing import Iterable, Dict
+from itertools import groupby
+from typing import Iterable, Dict, List, Optional, Set, Tuple
 
 import boto3
-from botocore.exceptions import ClientError
 import pystache
-from toolz import reduceby, first, compose, curry
+from configargparse import ArgumentTypeError
+from toolz import first, compose, curry
 from toolz.curried import get
 from wedding.general.functional import option
 from wedding.model import party_store, Party, Guest, NotInvited, PartyCodec, EmailAddress
 
-from invites.cli import parse_email_address
+from invites.aws import write_parties
+from invites.cli import parse_email_address, positive_float, positive_int
+from invites.metrics import instrumented, metrics
+from invites.ratelimit import TokenBucket
 
 TITLE_FIELD   = 'Title'
 EMAIL_FIELD   = 'Email'
@@ -37,35 +43,134 @@ def parse_bool(s: str) -> bool:
     return s.lower() == 'true'
 
 
+def _report(errors: Optional[List[str]], message: str) -> None:
+    if errors is None:
+        print(message)
+    else:
+        errors.append(message)
+
+
+def _database_writer(args,
+                     existing: Optional[Dict[str, Party]],
+                     titles: Set[str]):
+    limiter = option.fmap(TokenBucket)(args.write_rate)
+    return (
+        post_to_database(writers = args.writers, limiter = limiter) if existing is None else
+        reimport_to_database(existing, titles = titles, writers = args.writers, dry_run = args.dry_run, limiter = limiter)
+    )
+
+
+@curry
+def counted(name: str, items: Iterable) -> Iterable:
+    for item in items:
+        metrics.count(name)
+        yield item
+
+
 def main(args):
-    write_to_html = write_party_html(args.html_template)
-    compose(
-        option.cata(write_to_html   , lambda: identity)(args.html_output  ),
-        option.cata(post_to_database, lambda: identity)(args.parties_table),
-        option.cata(write_party_json, lambda: identity)(args.write_json   ),
-        parse_parties,
-        read_addresses
+    errors = []     # type: List[str]
+    titles = set()  # type: Set[str]
+    with metrics.stage('load_existing'):
+        existing = existing_parties(args.parties_table) if args.reimport else None
+
+    outputs = [
+        (name, output)
+        for name, output in [
+            ('write_json'    , option.fmap(write_party_json)(args.write_json)),
+            ('write_database', option.fmap(_database_writer(args, existing, titles))(args.parties_table)),
+            ('write_html'    , option.fmap(write_party_html(args.html_template, page_size = args.html_page_size))(args.html_output))
+        ]
+        if output is not None
+    ]
+
+    parties = compose(
+        option.cata(reuse_ids, lambda: identity)(existing),
+        counted('parties_parsed'),
+        parse_parties(errors = errors),
+        read_addresses(sorted_input = args.sorted, titles = titles)
     )(args.address_file)
 
+    # Parties are streamed, so they are only held in memory when more than
+    # one output has to read them.
+    if len(outputs) > 1:
+        with metrics.stage('parse'):
+            parties = list(parties)
+
+    for name, output in outputs:
+        with metrics.stage(name):
+            output(parties)
+
+    metrics.count('problems', len(errors))
+
+    if errors:
+        print(f'{len(errors)} problems in {args.address_file}; the affected parties were skipped:')
+        for error in errors:
+            print(f'  {error}')
+
 
 def parse_arguments():
     parser = argparse.ArgumentParser()
     parser.add_argument('--address-file', default = 'addresses.csv')
+    parser.add_argument('--sorted', action = 'store_true',
+                        help = 'The address file is sorted by Title, so parties are streamed in bounded memory; a party split across the file stops the import')
     parser.add_argument('--html-template', default = 'resources/parties_template.html')
     parser.add_argument('--parties-table')
+    parser.add_argument('--writers', type = positive_int, default = 4)
+    parser.add_argument('--write-rate', type = positive_float,
+                        help = 'Party writes per second across all writers; unlimited by default')
     parser.add_argument('--write-json')
     parser.add_argument('--html-output')
-    return parser.parse_args()
+    parser.add_argument('--html-page-size', type = positive_int,
+                        help = 'Split the HTML report into linked pages of this many parties')
+    parser.add_argument('--reimport', action = 'store_true',
+                        help = 'Keep the IDs of parties already in --parties-table and only write what changed')
+    parser.add_argument('--dry-run', action = 'store_true',
+                        help = 'With --reimport, print the changes without writing them')
+    parser.add_argument('--metrics-file',
+                        help = 'File to write stage timings, API latencies and item counts to, or - for standard output')
+    parser.add_argument('--metrics-format', choices = ['json', 'prometheus'], default = 'json')
+    parser.add_argument('--profile',
+                        help = 'Run under cProfile and write the stats to this file')
+    args = parser.parse_args()
+    if args.reimport and args.parties_table is None:
+        parser.error('--reimport requires --parties-table')
+    if args.dry_run and not args.reimport:
+        parser.error('--dry-run only applies to --reimport')
+    return args
 
 
-def read_addresses(address_file: str) -> Dict[str, list]:
+# Yields (title, rows) per party. Sorted input is grouped as it is read, so
+# each party is emitted as soon as its last row has been seen. A party whose
+# rows turn out to be split across sorted input has already been emitted
+# without its later rows, so the import is stopped rather than carrying on.
+# Every title read, whether or not its party turns out to be valid, is added
+# to `titles`.
+@curry
+def read_addresses(address_file: str,
+                   sorted_input: bool = False,
+                   titles: Optional[Set[str]] = None) -> Iterable[Tuple[str, List[dict]]]:
+    titles = titles if titles is not None else set()
     with open(address_file, 'r', newline='') as fin:
-        return reduceby(
-            get(TITLE_FIELD),
-            lambda guests, row: guests + [row],
-            csv.DictReader(fin),
-            []
-        )
+        rows = csv.DictReader(fin)
+
+        if sorted_input:
+            seen = set()  # type: Set[str]
+            for party_title, party_rows in groupby(rows, get(TITLE_FIELD)):
+                if party_title in seen:
+                    raise ValueError(
+                        f'Party {party_title} is split across {address_file}, which is not sorted by {TITLE_FIELD}. '
+                        f'Parties read before it, including part of {party_title}, may already have been written; '
+                        f'import the file again without --sorted'
+                    )
+                seen.add(party_title)
+                titles.add(party_title)
+                yield party_title, list(party_rows)
+        else:
+            records = {}  # type: Dict[str, List[dict]]
+            for row in rows:
+                records.setdefault(row[TITLE_FIELD], []).append(row)
+            titles.update(records)
+            yield from records.items()
 
 
 def _nonempty_email(raw_email):
@@ -83,8 +188,33 @@ def _get_inviter(party_guests) -> EmailAddress:
     return INVITER_MAP[first(inviters)]
 
 
-def parse_parties(records: Dict[str, list]) -> Iterable[Party]:
-    for party_title, party_guests in records.items():
+# Checks every guest of a party at once, returning the parsed email addresses
+# and every problem found rather than stopping at the first one.
+def _validate_party(party_title: str,
+                    party_guests: List[dict]) -> Tuple[List[Optional[EmailAddress]], List[str]]:
+    emails   = []  # type: List[Optional[EmailAddress]]
+    problems = []  # type: List[str]
+    for guest in party_guests:
+        try:
+            emails.append(_nonempty_email(guest[EMAIL_FIELD]))
+        except ArgumentTypeError as exc:
+            emails.append(None)
+            problems.append(f'Party {party_title}: guest {guest[FIRST_FIELD]} {guest[LAST_FIELD]}: {exc}')
+    unknown = set(guest[INVITER_FIELD] for guest in party_guests) - set(INVITER_MAP)
+    if unknown:
+        problems.append(f'Party {party_title}: unknown inviters {unknown}')
+    return emails, problems
+
+
+@curry
+def parse_parties(records: Iterable[Tuple[str, List[dict]]],
+                  errors: Optional[List[str]] = None) -> Iterable[Party]:
+    for party_title, party_guests in records:
+        emails, problems = _validate_party(party_title, party_guests)
+        if problems:
+            for problem in problems:
+                _report(errors, problem)
+            continue
 
         yield Party(
             id    = str(uuid.uuid4()),
@@ -98,11 +228,11 @@ def parse_parties(records: Dict[str, list]) -> Iterable[Party]:
                     id         = str(uuid.uuid4()),
                     first_name = guest[FIRST_FIELD],
                     last_name  = guest[LAST_FIELD ],
-                    email      = _nonempty_email(guest[EMAIL_FIELD]),
+                    email      = email,
                     attending  = None,
                     rideshare  = None
                 )
-                for guest in party_guests
+                for guest, email in zip(party_guests, emails)
             ],
             inviter    = _get_inviter(party_guests),
             rsvp_stage = NotInvited
@@ -121,32 +251,181 @@ def write_party_json(filename: str,
         )
 
 
+# The {{#parties}} section of the report template, with its tags on lines of
+# their own, which mustache drops from the output.
+_PARTIES_SECTION = re.compile(
+    r'^[ \t]*\{\{#parties\}\}[ \t]*\n(.*?)^[ \t]*\{\{/parties\}\}[ \t]*(?:\n|$)',
+    re.MULTILINE | re.DOTALL
+)
+
+
+def _page_filename(output_filename: str, page: int) -> str:
+    stem, extension = os.path.splitext(output_filename)
+    return output_filename if page == 1 else f'{stem}-{page}{extension}'
+
+
+def _pagination(output_filename: str,
+                page: int,
+                has_next: bool) -> dict:
+    return {
+        'page'    : page,
+        'previous': None if page == 1 else os.path.basename(_page_filename(output_filename, page - 1)),
+        'next'    : None if not has_next else os.path.basename(_page_filename(output_filename, page + 1))
+    }
+
+
+# Renders the template's header, each party and its footer separately and
+# writes them as they are rendered, so the report is never held in memory.
+# With a page size, every page_size parties start a new, linked page:
+# report.html, report-2.html, and so on.
 @curry
 def write_party_html(template_filename: str,
                      output_filename: str,
-                     parties: Iterable[Party]) -> None:
-    with open(template_filename, 'r') as fin, open(output_filename, 'w') as fout:
-        fout.write(
-            pystache.render(
-                fin.read(),
-                { 'parties': parties }
-            )
-        )
+                     parties: Iterable[Party],
+                     page_size: Optional[int] = None) -> None:
+    if page_size is not None and page_size < 1:
+        raise ValueError(f'Page size must be positive, not {page_size}')
+
+    with open(template_filename, 'r') as fin:
+        template = fin.read()
+
+    section = _PARTIES_SECTION.search(template)
+    if section is None:
+        with open(output_filename, 'w') as fout:
+            fout.write(pystache.render(template, { 'parties': list(parties) }))
+        return
+
+    renderer = pystache.Renderer()
+    header   = pystache.parse(template[:section.start()])
+    block    = pystache.parse(section.group(1))
+    footer   = pystache.parse(template[section.end():])
 
+    remaining = iter(parties)
+    party     = next(remaining, None)
+    page      = 1
+    while True:
+        with open(_page_filename(output_filename, page), 'w') as fout:
+            fout.write(renderer.render(header, { 'pagination': None }))
+
+            written = 0
+            while party is not None and (page_size is None or written < page_size):
+                fout.write(renderer.render(block, party))
+                written += 1
+                party = next(remaining, None)
+
+            fout.write(renderer.render(
+                footer,
+                { 'pagination': None if page_size is None else _pagination(output_filename, page, party is not None) }
+            ))
+
+        if party is None:
+            return
+        page += 1
 
 
 @curry
 def post_to_database(table_name: str,
-                     parties: Iterable[Party]) -> None:
-    store = party_store(
-        boto3.resource('dynamodb').Table(table_name)
+                     parties: Iterable[Party],
+                     writers: int = 4,
+                     limiter: Optional[TokenBucket] = None) -> None:
+    for party, exc in write_parties(table_name, parties, writers = writers, limiter = limiter):
+        print(f'Unable to put party {party.title} in database: {exc}')
+
+
+def existing_parties(table_name: str) -> Dict[str, Party]:
+    existing = {}  # type: Dict[str, Party]
+    for party in party_store(boto3.resource('dynamodb').Table(table_name)).get_all():
+        if party.title in existing:
+            print(f'Party {party.title} is in the database more than once; only {existing[party.title].id} will be updated')
+        else:
+            existing[party.title] = party
+    return existing
+
+
+# A party already in the database keeps its ID, its guests' IDs (matched by
+# name) and any RSVP progress, so re-importing never invalidates invitations.
+# Each old guest is matched at most once: guests sharing a name are matched
+# by email address first, then in the order they are listed.
+def _merge_existing(party: Party,
+                    existing: Party) -> Party:
+    existing_guests = {}  # type: Dict[Tuple[str, str], List[Guest]]
+    for guest in existing.guests:
+        existing_guests.setdefault((guest.first_name, guest.last_name), []).append(guest)
+
+    def match(guest: Guest) -> Optional[Guest]:
+        candidates = existing_guests.get((guest.first_name, guest.last_name))
+        if not candidates:
+            return None
+        old = next((old for old in candidates if old.email == guest.email), candidates[0])
+        candidates.remove(old)
+        return old
+
+    def merge_guest(guest: Guest) -> Guest:
+        old = match(guest)
+        return guest if old is None else guest._replace(
+            id        = old.id,
+            attending = old.attending,
+            rideshare = old.rideshare
+        )
+
+    return party._replace(
+        id         = existing.id,
+        guests     = [merge_guest(guest) for guest in party.guests],
+        rsvp_stage = existing.rsvp_stage
     )
+
+
+@curry
+def reuse_ids(existing: Dict[str, Party],
+              parties: Iterable[Party]) -> Iterable[Party]:
     for party in parties:
-        try:
-            store.put(party)
-        except ClientError as exc:
-            print(f'Unable to put party {party.title} in database: {exc}')
+        yield party if party.title not in existing else _merge_existing(party, existing[party.title])
+
+
+# Parties are only removed when their title is nowhere in the address file:
+# `titles` holds every title read, including those of parties skipped for
+# problems, which keep whatever the database already has for them.
+@curry
+def reimport_to_database(existing: Dict[str, Party],
+                         table_name: str,
+                         parties: Iterable[Party],
+                         titles: Set[str],
+                         writers: int = 4,
+                         dry_run: bool = False,
+                         limiter: Optional[TokenBucket] = None) -> None:
+    existing_ids = set(party.id for party in existing.values())
+    added        = []     # type: List[Party]
+    changed      = []     # type: List[Party]
+    imported     = set()  # type: Set[str]
+
+    for party in parties:
+        imported.add(party.title)
+        if party.id not in existing_ids:
+            added.append(party)
+        elif party != existing[party.title]:
+            changed.append(party)
+
+    removed   = [party for title, party in existing.items() if title not in titles and title not in imported]
+    unchanged = len(imported) - len(added) - len(changed)
+
+    print(f'{len(added)} added, {len(changed)} changed, {len(removed)} removed, {unchanged} unchanged')
+    for sign, parties_changed in [('+', added), ('~', changed), ('-', removed)]:
+        for party in parties_changed:
+            print(f'  {sign} {party.title} ({party.id})')
+
+    if dry_run:
+        return
+
+    for party, exc in write_parties(table_name, added + changed, removed, writers, limiter = limiter):
+        print(f'Unable to update party {party.title} in database: {exc}')
 
 
 if __name__ == '__main__':
-    main(parse_arguments())
+    args = parse_arguments()
+    instrumented(
+        lambda: main(args),
+        'import_addresses',
+        metrics_file   = args.metrics_file,
+        metrics_format = args.metrics_format,
+        profile_file   = args.profile
+    )
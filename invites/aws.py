@@ -1,12 +1,40 @@
+from collections import namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from itertools import chain
 from os import listdir, path
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+import hashlib
+import os
+import queue
 import string
+import threading
+import urllib.parse
 
 import boto3
 from botocore.exceptions import ClientError
+from toolz import partition_all
 from toolz.functoolz import excepts
 from wedding.general.functional import option
 from wedding.general.store import Store
-from wedding.model import Party
+from wedding.model import Party, PartyCodec
+
+from invites.manifest import read_manifest, write_manifest
+from invites.metrics import metrics
+from invites.ratelimit import Backoff, TokenBucket, aws_retry_after, call_with_retries
+
+
+UploadResult = namedtuple(
+    'UploadResult',
+    ['filename', 'key', 'error', 'skipped']
+)
+
+StageUpdateResult = namedtuple(
+    'StageUpdateResult',
+    ['party', 'error', 'changed']
+)
+
+
+MANIFEST_FILE = '.envelopes-manifest.json'
 
 
 def _is_image(filename: str) -> bool:
@@ -18,41 +46,381 @@ def _is_image(filename: str) -> bool:
     ])
 
 
+def _envelope_key_prefix(envelope_prefix: str) -> str:
+    return envelope_prefix + ('/' if not envelope_prefix.endswith('/') else '')
+
+
+def _md5(filename: str) -> str:
+    digest = hashlib.md5()
+    with open(filename, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 16), b''):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+# The manifest remembers each file's hash by size and modification time, so
+# unchanged files are not read again just to be compared.
+def _file_hash(envelope_file: str,
+               manifest_entry: Optional[dict]) -> dict:
+    stat  = os.stat(envelope_file)
+    entry = { 'size': stat.st_size, 'mtime': stat.st_mtime }
+    if manifest_entry is not None and \
+       manifest_entry.get('size') == entry['size'] and \
+       manifest_entry.get('mtime') == entry['mtime']:
+        return dict(entry, md5 = manifest_entry['md5'])
+    return dict(entry, md5 = _md5(envelope_file))
+
+
+# put_object uploads in a single part, so the ETag is the MD5 of the body.
+def _remote_etags(client,
+                  resource_bucket: str,
+                  key_prefix: str) -> Dict[str, str]:
+    return {
+        obj['Key']: obj['ETag'].strip('"')
+        for page in client.get_paginator('list_objects_v2').paginate(
+            Bucket = resource_bucket,
+            Prefix = key_prefix
+        )
+        for obj in page.get('Contents', [])
+    }
+
+
+def _party_tagging(party: Party) -> str:
+    return urllib.parse.urlencode({
+        'party': ''.join(filter(lambda c: c in string.ascii_letters, party.title))[:256]
+    })
+
+
+def _upload_envelope(client,
+                     limiter: Optional[TokenBucket],
+                     envelope_file: str,
+                     resource_bucket: str,
+                     envelope_key: str,
+                     tagging: Optional[str]) -> UploadResult:
+    tagging_args = option.cata(lambda t: { 'Tagging': t }, lambda: {})(tagging)
+
+    def put() -> None:
+        with open(envelope_file, 'rb') as body, metrics.timer('s3_put_object'):
+            client.put_object(
+                Bucket = resource_bucket,
+                Key    = envelope_key,
+                Body   = body,
+                **tagging_args
+            )
+
+    try:
+        call_with_retries(put, aws_retry_after, limiter)
+    except Exception as exc:
+        return UploadResult(envelope_file, envelope_key, exc, False)
+    return UploadResult(envelope_file, envelope_key, None, False)
+
+
+# Uploads envelopes as they are handed over, on a pool of threads fed through
+# a bounded queue. boto3 clients are thread-safe; the party store's table
+# resource is not, so parties are looked up on the thread calling upload.
+# on_uploaded is called, from any thread, with each envelope's result.
+class EnvelopeUploader:
+    def __init__(self,
+                 envelope_dir: str,
+                 resource_bucket: str,
+                 envelope_prefix: str,
+                 parties: Store[str, Party],
+                 workers: int = 8,
+                 force: bool = False,
+                 on_uploaded: Optional[Callable[[UploadResult], None]] = None,
+                 limiter: Optional[TokenBucket] = None) -> None:
+        self.__on_uploaded     = on_uploaded
+        self.__limiter         = limiter
+        self.__envelope_dir    = envelope_dir
+        self.__resource_bucket = resource_bucket
+        self.__parties         = parties
+        self.__client          = boto3.client('s3')
+        self.__key_prefix      = _envelope_key_prefix(envelope_prefix)
+        self.__manifest_file   = path.join(envelope_dir, MANIFEST_FILE)
+        self.__manifest        = read_manifest(self.__manifest_file)
+        self.__etags           = {} if force else self.__list_etags()
+        self.__hashes          = {}  # type: Dict[str, dict]
+        self.__results         = []  # type: List[UploadResult]
+        self.__results_lock    = threading.Lock()
+        self.__queue           = queue.Queue(maxsize = 2 * workers)  # type: queue.Queue
+        self.__threads         = [threading.Thread(target = self.__work) for _ in range(workers)]
+
+        for thread in self.__threads:
+            thread.start()
+
+    def __list_etags(self) -> Dict[str, str]:
+        with metrics.timer('s3_list_objects'):
+            return _remote_etags(self.__client, self.__resource_bucket, self.__key_prefix)
+
+    def __work(self) -> None:
+        while True:
+            upload = self.__queue.get()
+            if upload is None:
+                return
+            self.__add_result(_upload_envelope(self.__client, self.__limiter, *upload))
+
+    def __add_result(self, result: UploadResult) -> None:
+        with self.__results_lock:
+            self.__results.append(result)
+        if self.__on_uploaded is not None:
+            self.__on_uploaded(result)
+
+    def upload(self, envelope_file: str) -> None:
+        envelope = path.basename(envelope_file)
+        if envelope in self.__hashes:
+            return
+
+        envelope_key            = self.__key_prefix + envelope
+        self.__hashes[envelope] = _file_hash(envelope_file, self.__manifest.get(envelope))
+
+        if self.__etags.get(envelope_key) == self.__hashes[envelope]['md5']:
+            self.__add_result(UploadResult(envelope_file, envelope_key, None, True))
+            return
+
+        maybe_party = excepts(
+            ClientError,
+            self.__parties.get
+        )(path.splitext(envelope)[0])
+
+        self.__queue.put((
+            envelope_file,
+            self.__resource_bucket,
+            envelope_key,
+            option.fmap(_party_tagging)(maybe_party)
+        ))
+
+    def upload_directory(self, exclude: Iterable[str] = ()) -> None:
+        excluded = set(exclude)
+
+        for envelope in sorted(listdir(self.__envelope_dir)):
+            envelope_file = path.join(self.__envelope_dir, envelope)
+
+            if path.isfile(envelope_file) and _is_image(envelope_file) and \
+               path.splitext(envelope)[0] not in excluded:
+                self.upload(envelope_file)
+
+    def close(self) -> List[UploadResult]:
+        for _ in self.__threads:
+            self.__queue.put(None)
+        for thread in self.__threads:
+            thread.join()
+
+        results  = sorted(self.__results, key = lambda result: result.filename)
+        manifest = dict(self.__manifest)
+        for result in results:
+            envelope = path.basename(result.filename)
+            if result.error is None:
+                manifest[envelope] = self.__hashes[envelope]
+            else:
+                manifest.pop(envelope, None)
+        write_manifest(self.__manifest_file, manifest)
+
+        for result in results:
+            if result.error is not None:
+                print(f'Unable to upload envelope {result.filename} to {result.key}: {result.error}')
+
+        uploaded = sum(1 for result in results if result.error is None and not result.skipped)
+        skipped  = sum(1 for result in results if result.skipped)
+        metrics.count('envelopes_uploaded', uploaded)
+        metrics.count('envelopes_upload_skipped', skipped)
+        metrics.count('envelopes_upload_failed', len(results) - uploaded - skipped)
+        print(f'Uploaded {uploaded} envelopes, skipped {skipped} unchanged')
+
+        return results
+
+
 def upload_envelopes(envelope_dir: str,
                      resource_bucket: str,
                      envelope_prefix: str,
-                     parties: Store[str, Party]) -> None:
-    client = boto3.client('s3')
+                     parties: Store[str, Party],
+                     workers: int = 8,
+                     force: bool = False) -> List[UploadResult]:
+    uploader = EnvelopeUploader(envelope_dir, resource_bucket, envelope_prefix, parties, workers, force)
+    try:
+        uploader.upload_directory()
+    finally:
+        results = uploader.close()
+    return results
 
-    for envelope in listdir(envelope_dir):
-        envelope_file = path.join(envelope_dir, envelope)
 
-        if path.isfile(envelope_file) and _is_image(envelope_file):
-            maybe_party = excepts(
-                ClientError,
-                parties.get
-            )(path.splitext(path.basename(envelope_file))[0])
+# DynamoDB accepts at most 25 items per BatchWriteItem call.
+_BATCH_WRITE_LIMIT = 25
 
-            envelope_key = envelope_prefix + ('/' if not envelope_prefix.endswith('/') else '') + envelope
+_dynamodb = threading.local()
 
-            client.upload_file(
-                envelope_file,
-                resource_bucket,
-                envelope_key
-            )
 
-            option.fmap(
-                lambda party:
-                client.put_object_tagging(
-                    Bucket = resource_bucket,
-                    Key    = envelope_key   ,
-                    Tagging = {
-                        'TagSet': [
-                            {
-                                'Key': 'party',
-                                'Value': ''.join(filter(lambda c: c in string.ascii_letters, party.title))[:256]
-                            }
-                        ]
-                    }
+def _thread_dynamodb():
+    if not hasattr(_dynamodb, 'resource'):
+        _dynamodb.resource = boto3.session.Session().resource('dynamodb')
+    return _dynamodb.resource
+
+
+def _write_request(party: Party, delete: bool) -> dict:
+    return (
+        { 'DeleteRequest': { 'Key': { 'id': party.id } } } if delete else
+        { 'PutRequest': { 'Item': PartyCodec.encode(party) } }
+    )
+
+
+def _request_id(request: dict) -> str:
+    return (
+        request['DeleteRequest']['Key']['id'] if 'DeleteRequest' in request else
+        request['PutRequest']['Item']['id']
+    )
+
+
+# Unprocessed items and throttled calls are both retried with backoff; the
+# limiter is charged one unit per item written.
+def _write_party_batch(table_name: str,
+                       writes: List[Tuple[Party, bool]],
+                       backoff: Backoff,
+                       limiter: Optional[TokenBucket]) -> List[Tuple[Party, Exception]]:
+    metrics.count('party_writes', len(writes))
+    by_id       = { party.id: party for party, _ in writes }
+    requests    = [_write_request(party, delete) for party, delete in writes]
+    retry_after = 0.0
+
+    for attempt in range(backoff.max_attempts):
+        if attempt > 0:
+            backoff.sleep(attempt - 1, retry_after)
+        if limiter is not None:
+            limiter.acquire(len(requests))
+        try:
+            with metrics.timer('dynamodb_batch_write_item'):
+                response = _thread_dynamodb().batch_write_item(RequestItems = { table_name: requests })
+        except ClientError as exc:
+            retry_after = aws_retry_after(exc)
+            if retry_after is None:
+                return [(by_id[_request_id(request)], exc) for request in requests]
+            metrics.count('dynamodb_throttled', len(requests))
+            continue
+
+        requests    = response.get('UnprocessedItems', {}).get(table_name, [])
+        retry_after = 0.0
+        if not requests:
+            return []
+
+    return [
+        (
+            by_id[_request_id(request)],
+            RuntimeError(f'still unprocessed after {backoff.max_attempts} attempts')
+        )
+        for request in requests
+    ]
+
+
+def write_parties(table_name: str,
+                  puts: Iterable[Party],
+                  deletes: Iterable[Party] = (),
+                  writers: int = 4,
+                  max_attempts: int = 8,
+                  limiter: Optional[TokenBucket] = None) -> List[Tuple[Party, Exception]]:
+    backoff = Backoff(base = 0.05, cap = 5.0, max_attempts = max_attempts)
+    writes = chain(
+        ((party, False) for party in puts),
+        ((party, True ) for party in deletes)
+    )
+    with ThreadPoolExecutor(max_workers = writers) as executor:
+        batches = [
+            executor.submit(_write_party_batch, table_name, list(batch), backoff, limiter)
+            for batch in partition_all(_BATCH_WRITE_LIMIT, writes)
+        ]
+        failures = [failure for batch in batches for failure in batch.result()]
+
+    metrics.count('party_writes_failed', len(failures))
+    return failures
+
+
+# The party table attribute PartyCodec keeps the rsvp stage in, found from
+# the codec itself: the one attribute that changes when `party` is encoded
+# at `stage` instead of its own stage, which must differ.
+def rsvp_stage_attribute(party: Party, stage) -> str:
+    before  = PartyCodec.encode(party)
+    after   = PartyCodec.encode(party._replace(rsvp_stage = stage))
+    changed = [attribute for attribute, value in after.items() if before.get(attribute) != value]
+    if len(changed) != 1:
+        raise ValueError(f'Expected PartyCodec to keep the rsvp stage in one attribute, but {changed} changed')
+    return changed[0]
+
+
+# Moves parties to an rsvp stage with conditional updates of that one
+# attribute, instead of reading and writing back whole items. A party is only
+# updated while its stage is still the one it was read with, so stages guests
+# have moved on since (by responding) are left alone. DynamoDB cannot batch
+# updates, so they are made concurrently as parties are handed over.
+class RsvpStageUpdater:
+    def __init__(self,
+                 table_name: str,
+                 stage,
+                 workers: int = 4,
+                 limiter: Optional[TokenBucket] = None,
+                 max_attempts: int = 8) -> None:
+        self.__table_name = table_name
+        self.__stage      = stage
+        self.__limiter    = limiter
+        self.__backoff    = Backoff(base = 0.05, cap = 5.0, max_attempts = max_attempts)
+        self.__executor   = ThreadPoolExecutor(max_workers = workers)
+        self.__lock       = threading.Lock()
+        self.__updates    = []    # type: List[Future]
+        self.__attribute  = None  # type: Optional[str]
+
+    # Found once, from the first party that is not at the stage yet.
+    def __stage_attribute(self, party: Party) -> str:
+        with self.__lock:
+            if self.__attribute is None:
+                self.__attribute = rsvp_stage_attribute(party, self.__stage)
+            return self.__attribute
+
+    def __update(self, party: Party) -> StageUpdateResult:
+        try:
+            before = PartyCodec.encode(party)
+            after  = PartyCodec.encode(party._replace(rsvp_stage = self.__stage))
+            if before == after:
+                return StageUpdateResult(party, None, False)
+            attribute = self.__stage_attribute(party)
+        except Exception as exc:
+            return StageUpdateResult(party, exc, False)
+        expected, value = before.get(attribute), after[attribute]
+
+        def update() -> None:
+            with metrics.timer('dynamodb_update_rsvp_stage'):
+                _thread_dynamodb().Table(self.__table_name).update_item(
+                    Key                       = { 'id': party.id },
+                    UpdateExpression          = 'SET #stage = :stage',
+                    ConditionExpression       = '#stage = :expected',
+                    ExpressionAttributeNames  = { '#stage': attribute },
+                    ExpressionAttributeValues = { ':stage': value, ':expected': expected }
                 )
-            )(maybe_party)
+
+        try:
+            call_with_retries(update, aws_retry_after, self.__limiter, self.__backoff)
+        except ClientError as exc:
+            if exc.response.get('Error', {}).get('Code') == 'ConditionalCheckFailedException':
+                return StageUpdateResult(party, None, True)
+            return StageUpdateResult(party, exc, False)
+        except Exception as exc:
+            return StageUpdateResult(party, exc, False)
+        return StageUpdateResult(party, None, False)
+
+    def update(self, party: Party) -> None:
+        with self.__lock:
+            self.__updates.append(self.__executor.submit(self.__update, party))
+
+    def close(self) -> List[StageUpdateResult]:
+        self.__executor.shutdown()
+        results = [update.result() for update in self.__updates]
+
+        for result in results:
+            party = result.party
+            if result.error is not None:
+                print(f'Unable to set party {party.id} ({party.title}) rsvp stage: {result.error}')
+            elif result.changed:
+                print(f'Left party {party.id} ({party.title}) rsvp stage as it is because it changed since it was read')
+
+        failed  = sum(1 for result in results if result.error is not None)
+        changed = sum(1 for result in results if result.changed)
+        metrics.count('parties_emailed', len(results) - failed - changed)
+        metrics.count('parties_update_failed', failed)
+        metrics.count('parties_update_skipped', changed)
+
+        return results
@@ -1,15 +1,24 @@
+import os
 import re
 import string
-from typing import List
+from typing import List, Optional, Tuple
 
 from configargparse import ArgumentTypeError, ArgParser
 from wedding.model import EmailAddress
 
+from invites.google import MAX_BATCH_SIZE
+
+
+_EMAIL_ADDRESS = re.compile("^([a-zA-Z0-9_.+-]+)@([a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+)$")
+
+
+# Font size of party titles drawn by the native engine.
+_FONT_SIZE = 48
+
 
 def parse_email_address(raw: str) -> EmailAddress:
     if len(raw) > 7:
-        match = re.match(
-            "^([a-zA-Z0-9_.+-]+)@([a-zA-Z0-9-]+\.[a-zA-Z0-9-.]+)$",
+        match = _EMAIL_ADDRESS.match(
             raw.lower().lstrip(string.whitespace).rstrip(string.whitespace)
         )
         if match:
@@ -17,6 +26,41 @@ def parse_email_address(raw: str) -> EmailAddress:
     raise ArgumentTypeError(f'{raw} is not a valid email address')
 
 
+def positive_int(raw: str) -> int:
+    try:
+        value = int(raw)
+    except ValueError:
+        raise ArgumentTypeError(f'{raw} is not an integer')
+    if value < 1:
+        raise ArgumentTypeError(f'{raw} is not a positive integer')
+    return value
+
+
+def positive_float(raw: str) -> float:
+    try:
+        value = float(raw)
+    except ValueError:
+        raise ArgumentTypeError(f'{raw} is not a number')
+    if value <= 0:
+        raise ArgumentTypeError(f'{raw} is not a positive number')
+    return value
+
+
+def _batch_size(raw: str) -> int:
+    value = positive_int(raw)
+    if value > MAX_BATCH_SIZE:
+        raise ArgumentTypeError(f'{raw} is more than the {MAX_BATCH_SIZE} calls Gmail accepts in one batch')
+    return value
+
+
+def _position(raw: str) -> Tuple[float, float]:
+    try:
+        x, y = (float(coordinate) for coordinate in raw.split(','))
+    except ValueError:
+        raise ArgumentTypeError(f'{raw} is not a position of the form "x,y"')
+    return x, y
+
+
 def _template(filename: str) -> str:
     try:
         with open(filename, 'r') as fin:
@@ -28,8 +72,10 @@ def _template(filename: str) -> str:
 class Arguments:
     def __init__(self, args):
         self.__parties_table      = args.parties_table
+        self.__parties_snapshot   = args.parties_snapshot
         self.__client_secret_file = args.client_secret_file
         self.__token_storage_file = args.token_storage_file
+        self.__discovery_cache    = args.discovery_cache_file
         self.__html_template      = args.html_template
         self.__gimp_path          = args.gimp_path
         self.__gimp_template      = args.gimp_template
@@ -39,15 +85,43 @@ class Arguments:
         self.__envelope_url       = args.envelope_url_template
         self.__resource_bucket    = args.resource_bucket
         self.__envelope_prefix    = args.envelope_prefix
-        self.__send               = args.send
+        self.__send               = args.send or args.send_existing
+        self.__send_existing      = args.send_existing
+        self.__all_senders        = args.all_senders
         self.__skip_envelopes     = args.skip_envelopes
         self.__skip_email         = args.skip_email
+        self.__sequential         = args.sequential
+        self.__wait_for_envelopes = args.wait_for_envelopes
         self.__only               = args.only
+        self.__concurrency        = args.concurrency
+        self.__batch_size         = args.batch_size
+        self.__upload_workers     = args.upload_workers
+        self.__force              = args.force
+        self.__gmail_quota        = args.gmail_quota
+        self.__s3_rate            = args.s3_rate
+        self.__dynamodb_rate      = args.dynamodb_write_rate
+        self.__journal            = args.journal
+        self.__resume             = args.resume
+        self.__retry_failed       = args.retry_failed
+        self.__metrics_file       = args.metrics_file
+        self.__metrics_format     = args.metrics_format
+        self.__profile            = args.profile
+        self.__render_workers     = args.render_workers
+        self.__envelope_engine    = args.envelope_engine
+        self.__envelope_base      = args.envelope_base_image
+        self.__envelope_font      = args.envelope_font
+        self.__envelope_font_size = args.envelope_font_size if args.envelope_font_size is not None else _FONT_SIZE
+        self.__envelope_position  = args.envelope_text_position
+        self.__envelope_color     = args.envelope_text_color
 
     @property
     def parties_table(self) -> str:
         return self.__parties_table
 
+    @property
+    def parties_snapshot(self) -> Optional[str]:
+        return self.__parties_snapshot
+
     @property
     def client_secret_file(self) -> str:
         return self.__client_secret_file
@@ -56,6 +130,10 @@ class Arguments:
     def token_storage_file(self) -> str:
         return self.__token_storage_file
 
+    @property
+    def discovery_cache_file(self) -> Optional[str]:
+        return self.__discovery_cache
+
     @property
     def html_template(self) -> str:
         return self.__html_template
@@ -96,6 +174,14 @@ class Arguments:
     def send(self) -> bool:
         return self.__send
 
+    @property
+    def send_existing(self) -> bool:
+        return self.__send_existing
+
+    @property
+    def all_senders(self) -> bool:
+        return self.__all_senders
+
     @property
     def skip_envelopes(self) -> bool:
         return self.__skip_envelopes
@@ -104,10 +190,98 @@ class Arguments:
     def skip_email(self) -> bool:
         return self.__skip_email
 
+    @property
+    def sequential(self) -> bool:
+        return self.__sequential
+
+    @property
+    def wait_for_envelopes(self) -> bool:
+        return self.__wait_for_envelopes
+
     @property
     def only(self) -> List[str]:
         return self.__only
 
+    @property
+    def concurrency(self) -> int:
+        return self.__concurrency
+
+    @property
+    def batch_size(self) -> int:
+        return self.__batch_size
+
+    @property
+    def upload_workers(self) -> int:
+        return self.__upload_workers
+
+    @property
+    def force(self) -> bool:
+        return self.__force
+
+    @property
+    def gmail_quota(self) -> Optional[float]:
+        return self.__gmail_quota
+
+    @property
+    def s3_rate(self) -> Optional[float]:
+        return self.__s3_rate
+
+    @property
+    def dynamodb_write_rate(self) -> Optional[float]:
+        return self.__dynamodb_rate
+
+    @property
+    def render_workers(self) -> int:
+        return self.__render_workers
+
+    @property
+    def envelope_engine(self) -> str:
+        return self.__envelope_engine
+
+    @property
+    def envelope_base_image(self) -> Optional[str]:
+        return self.__envelope_base
+
+    @property
+    def envelope_font(self) -> Optional[str]:
+        return self.__envelope_font
+
+    @property
+    def envelope_font_size(self) -> int:
+        return self.__envelope_font_size
+
+    @property
+    def envelope_text_position(self) -> Tuple[float, float]:
+        return self.__envelope_position
+
+    @property
+    def envelope_text_color(self) -> str:
+        return self.__envelope_color
+
+    @property
+    def journal(self) -> str:
+        return self.__journal
+
+    @property
+    def resume(self) -> bool:
+        return self.__resume
+
+    @property
+    def retry_failed(self) -> bool:
+        return self.__retry_failed
+
+    @property
+    def metrics_file(self) -> Optional[str]:
+        return self.__metrics_file
+
+    @property
+    def metrics_format(self) -> str:
+        return self.__metrics_format
+
+    @property
+    def profile(self) -> Optional[str]:
+        return self.__profile
+
 
 def parse_arguments() -> Arguments:
     parser = ArgParser(default_config_files=['settings.conf'])
@@ -115,6 +289,12 @@ def parse_arguments() -> Arguments:
         '--parties-table',
         env_var = 'PARTIES_TABLE'
     )
+    parser.add_argument(
+        '--parties-snapshot',
+        env_var = 'PARTIES_SNAPSHOT',
+        help = 'Read parties from this snapshot file (see export_parties.py) instead of scanning --parties-table. ' +
+               'Rsvp stage updates still go to --parties-table if given, and are otherwise not saved.'
+    )
     parser.add_argument(
         '--client-secret-file',
         default = 'secrets/client_secret.json',
@@ -125,6 +305,12 @@ def parse_arguments() -> Arguments:
         default = 'secrets/tokens.json',
         env_var = 'TOKEN_STORAGE_FILE'
     )
+    parser.add_argument(
+        '--discovery-cache-file',
+        default = 'secrets/gmail-discovery.json',
+        env_var = 'DISCOVERY_CACHE_FILE',
+        help = 'File caching the Gmail API discovery document between runs'
+    )
     parser.add_argument(
         '--html-template',
         default = 'resources/email_template.html',
@@ -140,6 +326,49 @@ def parse_arguments() -> Arguments:
         '--gimp-template',
         env_var = 'GIMP_TEMPLATE'
     )
+    parser.add_argument(
+        '--render-workers',
+        env_var = 'RENDER_WORKERS',
+        help = 'Number of GIMP processes to render envelopes with. Defaults to the number of CPUs.',
+        type = positive_int,
+        default = os.cpu_count() or 1
+    )
+    parser.add_argument(
+        '--envelope-engine',
+        env_var = 'ENVELOPE_ENGINE',
+        help = 'Render envelopes with GIMP, or natively in Python with Pillow.',
+        choices = ['gimp', 'native'],
+        default = 'gimp'
+    )
+    parser.add_argument(
+        '--envelope-base-image',
+        env_var = 'ENVELOPE_BASE_IMAGE',
+        help = 'Flattened envelope image used by the native engine, ' +
+               'e.g. resources/Envelope-Flattened.xcf exported as PNG. Required by the native engine.'
+    )
+    parser.add_argument(
+        '--envelope-font',
+        env_var = 'ENVELOPE_FONT',
+        help = 'TrueType font the native engine writes party titles in.'
+    )
+    parser.add_argument(
+        '--envelope-font-size',
+        env_var = 'ENVELOPE_FONT_SIZE',
+        help = f'Size of --envelope-font, {_FONT_SIZE} by default. Pillow\'s built-in font only comes in one size.',
+        type = positive_int
+    )
+    parser.add_argument(
+        '--envelope-text-position',
+        env_var = 'ENVELOPE_TEXT_POSITION',
+        help = 'Center of the party title as fractions of the envelope width and height, e.g. "0.5,0.6".',
+        type = _position,
+        default = '0.5,0.5'
+    )
+    parser.add_argument(
+        '--envelope-text-color',
+        env_var = 'ENVELOPE_TEXT_COLOR',
+        default = '#000000'
+    )
     parser.add_argument(
         '--invitation-url',
         env_var = 'RSVP_URL',
@@ -153,6 +382,11 @@ def parse_arguments() -> Arguments:
         help = 'Email address to use to send invitations.',
         type = parse_email_address
     )
+    parser.add_argument(
+        '--all-senders',
+        action = 'store_true',
+        help = "Mail every inviter's parties in one run, each from the inviter's own account, instead of only --sender's"
+    )
     parser.add_argument(
         '--envelopes-dir',
         env_var = 'ENVELOPES_DIR',
@@ -180,6 +414,11 @@ def parse_arguments() -> Arguments:
         action = 'store_true',
         help = 'Send emails. USE ONLY WHEN ABSOLUTELY READY TO INVITE EVERYONE!'
     )
+    parser.add_argument(
+        '--send-existing',
+        action = 'store_true',
+        help = "Send the drafts already in the sender's mailbox instead of rendering new ones; implies --send"
+    )
     parser.add_argument(
         '--skip-envelopes',
         action = 'store_true',
@@ -190,10 +429,104 @@ def parse_arguments() -> Arguments:
         action = 'store_true',
         help = 'Do not create or send email invitations'
     )
+    parser.add_argument(
+        '--sequential',
+        action = 'store_true',
+        help = 'Create emails only after every envelope is rendered and uploaded, instead of alongside them'
+    )
+    parser.add_argument(
+        '--wait-for-envelopes',
+        action = 'store_true',
+        help = "Draft emails right away, but only send a party's invitations once its envelope is uploaded"
+    )
     parser.add_argument(
         '--only',
         action = 'append',
         help = 'Only operate on the parties with these IDs',
         default = []
     )
-    return Arguments(parser.parse_args())
+    parser.add_argument(
+        '--concurrency',
+        env_var = 'CONCURRENCY',
+        help = 'Number of Gmail requests to run in parallel.',
+        type = positive_int,
+        default = 1
+    )
+    parser.add_argument(
+        '--batch-size',
+        env_var = 'BATCH_SIZE',
+        help = f'Number of Gmail calls to group into one batch HTTP request (1 to {MAX_BATCH_SIZE}).',
+        type = _batch_size,
+        default = 50
+    )
+    parser.add_argument(
+        '--upload-workers',
+        env_var = 'UPLOAD_WORKERS',
+        help = 'Number of envelopes to upload to S3 in parallel.',
+        type = positive_int,
+        default = 8
+    )
+    parser.add_argument(
+        '--force',
+        action = 'store_true',
+        help = 'Render and upload every envelope, even those unchanged since the last run'
+    )
+    parser.add_argument(
+        '--gmail-quota',
+        env_var = 'GMAIL_QUOTA',
+        help = 'Gmail quota units to use per second (a draft costs 10 to create and 100 to send)',
+        type = positive_float,
+        default = 250
+    )
+    parser.add_argument(
+        '--s3-rate',
+        env_var = 'S3_RATE',
+        help = 'Envelope uploads per second',
+        type = positive_float,
+        default = 3500
+    )
+    parser.add_argument(
+        '--dynamodb-write-rate',
+        env_var = 'DYNAMODB_WRITE_RATE',
+        help = 'Party updates per second; unlimited by default, for on-demand tables',
+        type = positive_float
+    )
+    parser.add_argument(
+        '--journal',
+        env_var = 'MAILING_JOURNAL',
+        help = 'File recording the outcome of every invitation drafted or sent.',
+        default = 'mailing-journal.jsonl'
+    )
+    resume = parser.add_mutually_exclusive_group()
+    resume.add_argument(
+        '--resume',
+        action = 'store_true',
+        help = 'Skip invitations the journal records as done; send drafts it records as created'
+    )
+    resume.add_argument(
+        '--retry-failed',
+        action = 'store_true',
+        help = 'Only retry invitations the journal records as failed or still unsent'
+    )
+    parser.add_argument(
+        '--metrics-file',
+        env_var = 'METRICS_FILE',
+        help = 'File to write stage timings, API latencies and item counts to at the end of the run, or - for standard output.'
+    )
+    parser.add_argument(
+        '--metrics-format',
+        env_var = 'METRICS_FORMAT',
+        choices = ['json', 'prometheus'],
+        default = 'json'
+    )
+    parser.add_argument(
+        '--profile',
+        help = 'Run under cProfile and write the stats to this file'
+    )
+
+    args = parser.parse_args()
+    if args.envelope_engine == 'native' and not args.skip_envelopes and args.envelope_base_image is None:
+        parser.error('--envelope-engine native requires --envelope-base-image')
+    if args.envelope_font_size is not None and args.envelope_font is None:
+        parser.error('--envelope-font-size requires --envelope-font')
+    return Arguments(args)
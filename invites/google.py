@@ -1,16 +1,27 @@
 import json
 import pathlib
+import threading
+import time
+from collections import namedtuple
+from typing import Any, Callable, Dict, List, Optional, TYPE_CHECKING
 
-from apiclient import discovery
-from google.oauth2.credentials import Credentials
-from google_auth_oauthlib.flow import Flow
 from toolz.dicttoolz import assoc
 from wedding.general.functional import option
 from wedding.model import EmailAddress
-from invites.render import email_address
+from invites.manifest import read_manifest, write_manifest
+from invites.metrics import metrics
+from invites.ratelimit import Backoff, TokenBucket, call_with_retries, parse_retry_after
+from invites.render import GUEST_HEADER, email_address
+
+# The Google client libraries are slow to import, so they are imported where
+# they are used and only runs that talk to Gmail pay for them.
+if TYPE_CHECKING:
+    from google.oauth2.credentials import Credentials
 
 
 def _get_new_credentials(client_secret_file: str):
+    from google_auth_oauthlib.flow import Flow
+
     flow = Flow.from_client_secrets_file(
         client_secret_file,
         scopes=['https://www.googleapis.com/auth/gmail.compose'],
@@ -39,42 +50,314 @@ def _save_tokens(token_storage_file: str, tokens):
 
 def get_credentials(client_secret_file: str,
                     token_storage_file: str,
-                    user_id: str) -> Credentials:
+                    user_id: str) -> 'Credentials':
+    from google.oauth2.credentials import Credentials
+
     tokens = _get_tokens(token_storage_file)
     credentials = option.cata(
         Credentials,
         lambda: _get_new_credentials(client_secret_file)
     )(tokens.get(user_id))
-    _save_tokens(token_storage_file, assoc(tokens, user_id, credentials.token))
+    if tokens.get(user_id) != credentials.token:
+        _save_tokens(token_storage_file, assoc(tokens, user_id, credentials.token))
     return credentials
 
 
+# Discovery documents rarely change, so they are kept for a day rather than
+# fetched again by every run (and every thread's service).
+_DISCOVERY_MAX_AGE = 24 * 60 * 60
+
+
+# Implements googleapiclient's discovery cache interface (get and set by
+# discovery URL) over a JSON file.
+class DiscoveryCache:
+    def __init__(self, cache_file: str) -> None:
+        self.__cache_file = cache_file
+        self.__lock       = threading.Lock()
+        self.__documents  = read_manifest(cache_file)
+
+    def get(self, url: str) -> Optional[str]:
+        with self.__lock:
+            document = self.__documents.get(url)
+        if document is None or time.time() - document['time'] > _DISCOVERY_MAX_AGE:
+            return None
+        return document['content']
+
+    def set(self, url: str, content: str) -> None:
+        with self.__lock:
+            self.__documents[url] = { 'content': content, 'time': time.time() }
+            write_manifest(self.__cache_file, self.__documents)
+
+
+# Gmail rejects batch requests with more than 100 calls.
+MAX_BATCH_SIZE = 100
+
+
+BatchResult = namedtuple(
+    'BatchResult',
+    ['response', 'error']
+)
+
+
+# Gmail's per-user quota is 250 units a second; listing or reading drafts
+# costs 5 units a call, creating a draft 10 and sending one 100.
+GMAIL_QUOTA        = 250
+_LIST_DRAFTS_COST  = 5
+_GET_DRAFT_COST    = 5
+_CREATE_DRAFT_COST = 10
+_SEND_DRAFT_COST   = 100
+
+# The most drafts drafts.list returns in one page.
+_DRAFTS_PAGE_SIZE = 500
+
+# Headers read from existing drafts to tell which guest each one invites.
+_DRAFT_HEADERS = ['To', 'Subject', GUEST_HEADER]
+
+_RATE_LIMIT_REASONS = ['rateLimitExceeded', 'userRateLimitExceeded']
+
+
+# The reasons Google's JSON error body gives for an HttpError. HttpError's
+# message only carries the error's human-readable message, not its reasons.
+def _error_reasons(exc: Exception) -> List[str]:
+    content = getattr(exc, 'content', None)
+    try:
+        if isinstance(content, bytes):
+            content = content.decode('utf-8')
+        return [error.get('reason') for error in json.loads(content)['error']['errors']]
+    except (AttributeError, KeyError, TypeError, ValueError):
+        return []
+
+
+# Only rejections for exceeding the quota are retried: after any other error
+# the draft may have been created, or the email sent, already.
+def _gmail_retry_after(exc: Exception) -> Optional[float]:
+    resp = getattr(exc, 'resp', None)
+    if resp is None:
+        return None
+    status = int(getattr(resp, 'status', 0))
+    if status == 429 or status == 403 and any(reason in _RATE_LIMIT_REASONS for reason in _error_reasons(exc)):
+        return parse_retry_after(resp.get('retry-after'))
+    return None
+
+
 class GmailService:
-    def __init__(self, service, user_id):
+    def __init__(self,
+                 service,
+                 user_id,
+                 limiter: Optional[TokenBucket] = None,
+                 backoff: Optional[Backoff] = None) -> None:
         self.__service = service
         self.__user_id = user_id
+        self.__limiter = limiter
+        self.__backoff = backoff or Backoff()
 
-    def create_draft(self,
-                     message: str):
+    def __create_request(self, message: str):
         return self.__service.users().drafts().create(
             userId = self.__user_id,
             body   = { 'message': { 'raw': message } }
-        ).execute()
+        )
 
-    def send(self, draft):
+    def __get_request(self, draft_id: str):
+        return self.__service.users().drafts().get(
+            userId          = self.__user_id,
+            id              = draft_id,
+            format          = 'metadata',
+            metadataHeaders = _DRAFT_HEADERS
+        )
+
+    def __send_request(self, draft):
         return self.__service.users().drafts().send(
             userId = self.__user_id,
             body   = draft
-        ).execute()
+        )
+
+    def __execute_chunk(self,
+                        make_request: Callable[[Any], Any],
+                        items: List,
+                        indices: List[int],
+                        results: List[BatchResult],
+                        cost: int) -> None:
+        def collect(request_id, response, exception):
+            results[int(request_id)] = BatchResult(response, exception)
+
+        if self.__limiter is not None:
+            self.__limiter.acquire(cost * len(indices))
+        batch = self.__service.new_batch_http_request(callback = collect)
+        for index in indices:
+            results[index] = None
+            batch.add(make_request(items[index]), request_id = str(index))
+        try:
+            with metrics.timer('gmail_batch'):
+                batch.execute()
+        except Exception as exc:
+            # Calls the callback already saw succeed (or fail) keep their
+            # result, so they are neither retried nor sent twice.
+            for index in indices:
+                if results[index] is None:
+                    results[index] = BatchResult(None, exc)
 
+    # Requests rejected for exceeding the quota are sent again, in a new
+    # batch, after backing off.
+    def __execute_batches(self,
+                          make_request: Callable[[Any], Any],
+                          items: List,
+                          cost: int) -> List[BatchResult]:
+        results = [None] * len(items)  # type: List[BatchResult]
+        pending = list(range(len(items)))
 
-def gmail_service(credentials: Credentials,
-                  sender: EmailAddress) -> GmailService:
+        for attempt in range(self.__backoff.max_attempts):
+            if attempt > 0:
+                metrics.count('gmail_throttled', len(pending))
+                self.__backoff.sleep(attempt - 1, max(_gmail_retry_after(results[index].error) for index in pending))
+            for start in range(0, len(pending), MAX_BATCH_SIZE):
+                self.__execute_chunk(make_request, items, pending[start:start + MAX_BATCH_SIZE], results, cost)
+            pending = [
+                index for index in pending
+                if results[index].error is not None and _gmail_retry_after(results[index].error) is not None
+            ]
+            if not pending:
+                break
+
+        return results
+
+    def create_draft(self,
+                     message: str):
+        with metrics.timer('gmail_create_draft'):
+            return call_with_retries(
+                self.__create_request(message).execute,
+                _gmail_retry_after,
+                self.__limiter,
+                self.__backoff,
+                _CREATE_DRAFT_COST
+            )
+
+    def send(self, draft):
+        with metrics.timer('gmail_send_draft'):
+            return call_with_retries(
+                self.__send_request(draft).execute,
+                _gmail_retry_after,
+                self.__limiter,
+                self.__backoff,
+                _SEND_DRAFT_COST
+            )
+
+    def create_drafts(self,
+                      messages: List[str]) -> List[BatchResult]:
+        return self.__execute_batches(self.__create_request, messages, _CREATE_DRAFT_COST)
+
+    def send_drafts(self, drafts: List) -> List[BatchResult]:
+        return self.__execute_batches(self.__send_request, drafts, _SEND_DRAFT_COST)
+
+    # Every draft in the mailbox, as the ids drafts.list returns, following
+    # the pages to the end.
+    def list_drafts(self) -> List[dict]:
+        drafts     = []  # type: List[dict]
+        page_token = None
+        while True:
+            request = self.__service.users().drafts().list(
+                userId     = self.__user_id,
+                maxResults = _DRAFTS_PAGE_SIZE,
+                pageToken  = page_token
+            )
+            with metrics.timer('gmail_list_drafts'):
+                page = call_with_retries(
+                    request.execute,
+                    _gmail_retry_after,
+                    self.__limiter,
+                    self.__backoff,
+                    _LIST_DRAFTS_COST
+                )
+            drafts.extend(page.get('drafts', []))
+            page_token = page.get('nextPageToken')
+            if page_token is None:
+                return drafts
+
+    # The drafts with their recipient and guest headers, but not their bodies.
+    def get_drafts(self,
+                   draft_ids: List[str]) -> List[BatchResult]:
+        return self.__execute_batches(self.__get_request, draft_ids, _GET_DRAFT_COST)
+
+
+# googleapiclient services share one httplib2.Http, which is not thread-safe,
+# so every thread gets its own service and HTTP client.
+class ThreadLocalGmailService(GmailService):
+    def __init__(self,
+                 build_service: Callable[[], Any],
+                 user_id: str,
+                 limiter: Optional[TokenBucket] = None,
+                 backoff: Optional[Backoff] = None) -> None:
+        self.__build_service = build_service
+        self.__user_id       = user_id
+        self.__limiter       = limiter
+        self.__backoff       = backoff
+        self.__local         = threading.local()
+
+    def __gmail(self) -> GmailService:
+        if not hasattr(self.__local, 'gmail'):
+            self.__local.gmail = GmailService(self.__build_service(), self.__user_id, self.__limiter, self.__backoff)
+        return self.__local.gmail
+
+    def create_draft(self,
+                     message: str):
+        return self.__gmail().create_draft(message)
+
+    def send(self, draft):
+        return self.__gmail().send(draft)
+
+    def create_drafts(self,
+                      messages: List[str]) -> List[BatchResult]:
+        return self.__gmail().create_drafts(messages)
+
+    def send_drafts(self, drafts: List) -> List[BatchResult]:
+        return self.__gmail().send_drafts(drafts)
+
+    def list_drafts(self) -> List[dict]:
+        return self.__gmail().list_drafts()
+
+    def get_drafts(self,
+                   draft_ids: List[str]) -> List[BatchResult]:
+        return self.__gmail().get_drafts(draft_ids)
+
+
+# The headers of a draft read by get_drafts, by lower-cased name.
+def draft_headers(draft: dict) -> Dict[str, str]:
+    return {
+        header['name'].lower(): header['value']
+        for header in draft.get('message', {}).get('payload', {}).get('headers', [])
+    }
+
+
+def _build_gmail(credentials: 'Credentials',
+                 cache: Optional[DiscoveryCache]):
+    from apiclient import discovery
+
+    return discovery.build(
+        'gmail',
+        'v1',
+        credentials = credentials,
+        cache       = cache
+    )
+
+
+def gmail_service(credentials: 'Credentials',
+                  sender: EmailAddress,
+                  discovery_cache_file: Optional[str] = None,
+                  quota: Optional[float] = GMAIL_QUOTA) -> GmailService:
     return GmailService(
-        discovery.build(
-            'gmail',
-            'v1',
-            credentials = credentials
-        ),
-        email_address(sender)
+        _build_gmail(credentials, option.fmap(DiscoveryCache)(discovery_cache_file)),
+        email_address(sender),
+        option.fmap(TokenBucket)(quota)
+    )
+
+
+# All threads share one rate limiter, since the quota is per user.
+def thread_local_gmail_service(credentials: 'Credentials',
+                               sender: EmailAddress,
+                               discovery_cache_file: Optional[str] = None,
+                               quota: Optional[float] = GMAIL_QUOTA) -> GmailService:
+    cache = option.fmap(DiscoveryCache)(discovery_cache_file)
+    return ThreadLocalGmailService(
+        lambda: _build_gmail(credentials, cache),
+        email_address(sender),
+        option.fmap(TokenBucket)(quota)
     )
@@ -0,0 +1,57 @@
+import json
+import threading
+import time
+from typing import Dict, Optional, Tuple
+
+DRAFTED = 'drafted'
+SENT    = 'sent'
+FAILED  = 'failed'
+
+
+# Append-only JSON lines record of what happened to each guest's invitation.
+# The last line for a (party, guest) pair is its current state, so an
+# interrupted run can be resumed without creating the same drafts again.
+class MailingJournal:
+    def __init__(self, filename: str) -> None:
+        self.__filename = filename
+        self.__lock     = threading.Lock()
+        self.__entries  = {}  # type: Dict[Tuple[str, str], dict]
+
+        try:
+            with open(filename, 'r') as fin:
+                for line in fin:
+                    try:
+                        entry = json.loads(line)
+                    except ValueError:
+                        # A line cut short by a crash; everything before it is intact.
+                        continue
+                    self.__entries[(entry['party'], entry['guest'])] = entry
+        except FileNotFoundError:
+            pass
+
+        self.__file = open(filename, 'a')
+
+    def entry(self, party_id: str, guest_id: str) -> Optional[dict]:
+        return self.__entries.get((party_id, guest_id))
+
+    def record(self,
+               party_id: str,
+               guest_id: str,
+               state: str,
+               draft_id: Optional[str] = None,
+               error: Optional[str] = None) -> None:
+        entry = {
+            'party': party_id,
+            'guest': guest_id,
+            'state': state,
+            'draft': draft_id,
+            'error': error,
+            'time' : time.strftime('%Y-%m-%dT%H:%M:%S')
+        }
+        with self.__lock:
+            self.__entries[(party_id, guest_id)] = entry
+            self.__file.write(json.dumps(entry) + '\n')
+            self.__file.flush()
+
+    def close(self) -> None:
+        self.__file.close()
@@ -0,0 +1,18 @@
+import json
+import os
+from typing import Any, Dict
+
+
+def read_manifest(manifest_file: str) -> Dict[str, Any]:
+    try:
+        with open(manifest_file, 'r') as fin:
+            return json.loads(fin.read())
+    except (FileNotFoundError, ValueError):
+        return {}
+
+
+def write_manifest(manifest_file: str,
+                   manifest: Dict[str, Any]) -> None:
+    with open(manifest_file + '.tmp', 'w') as fout:
+        fout.write(json.dumps(manifest, sort_keys = True))
+    os.replace(manifest_file + '.tmp', manifest_file)
@@ -0,0 +1,175 @@
+import cProfile
+import json
+import pstats
+import sys
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+from typing import Callable, Dict, Optional
+
+
+# Upper bounds, in seconds, of the latency histogram buckets; the last bucket
+# (+Inf) takes everything slower.
+LATENCY_BUCKETS = [0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0]
+
+
+class _Histogram:
+    def __init__(self) -> None:
+        self.counts = [0] * (len(LATENCY_BUCKETS) + 1)
+        self.total  = 0.0
+        self.count  = 0
+
+    def observe(self, seconds: float) -> None:
+        self.counts[bisect_left(LATENCY_BUCKETS, seconds)] += 1
+        self.total += seconds
+        self.count += 1
+
+
+# Wall time per stage, latency histograms per external call and item
+# counters for one run. Safe to update from any thread.
+class Metrics:
+    def __init__(self) -> None:
+        self.__lock       = threading.Lock()
+        self.__stages     = {}  # type: Dict[str, float]
+        self.__histograms = {}  # type: Dict[str, _Histogram]
+        self.__counters   = {}  # type: Dict[str, int]
+
+    @contextmanager
+    def stage(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_stage(name, time.perf_counter() - start)
+
+    def add_stage(self, name: str, seconds: float) -> None:
+        with self.__lock:
+            self.__stages[name] = self.__stages.get(name, 0.0) + seconds
+
+    def observe(self, name: str, seconds: float) -> None:
+        with self.__lock:
+            self.__histograms.setdefault(name, _Histogram()).observe(seconds)
+
+    @contextmanager
+    def timer(self, name: str):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - start)
+
+    def count(self, name: str, amount: int = 1) -> None:
+        with self.__lock:
+            self.__counters[name] = self.__counters.get(name, 0) + amount
+
+    def summary(self) -> dict:
+        with self.__lock:
+            return {
+                'stages'   : dict(self.__stages),
+                'counters' : dict(self.__counters),
+                'latencies': {
+                    name: {
+                        'count'  : histogram.count,
+                        'seconds': histogram.total,
+                        'buckets': dict(zip(
+                            [str(bound) for bound in LATENCY_BUCKETS] + ['+Inf'],
+                            histogram.counts
+                        ))
+                    }
+                    for name, histogram in self.__histograms.items()
+                }
+            }
+
+    def prometheus(self, prefix: str) -> str:
+        summary = self.summary()
+        lines   = [
+            f'# TYPE {prefix}_stage_seconds gauge'
+        ] + [
+            f'{prefix}_stage_seconds{{stage="{stage}"}} {seconds}'
+            for stage, seconds in summary['stages'].items()
+        ] + [
+            f'# TYPE {prefix}_items_total counter'
+        ] + [
+            f'{prefix}_items_total{{name="{name}"}} {count}'
+            for name, count in summary['counters'].items()
+        ] + [
+            f'# TYPE {prefix}_call_seconds histogram'
+        ]
+
+        for call, latency in summary['latencies'].items():
+            cumulative = 0
+            for bound, count in latency['buckets'].items():
+                cumulative += count
+                lines.append(f'{prefix}_call_seconds_bucket{{call="{call}",le="{bound}"}} {cumulative}')
+            lines.append(f'{prefix}_call_seconds_sum{{call="{call}"}} {latency["seconds"]}')
+            lines.append(f'{prefix}_call_seconds_count{{call="{call}"}} {latency["count"]}')
+
+        return '\n'.join(lines) + '\n'
+
+    def write(self,
+              filename: str,
+              output_format: str,
+              prefix: str) -> None:
+        report = (
+            self.prometheus(prefix) if output_format == 'prometheus' else
+            json.dumps(self.summary(), indent = 2) + '\n'
+        )
+        if filename == '-':
+            sys.stdout.write(report)
+        else:
+            with open(filename, 'w') as fout:
+                fout.write(report)
+
+
+# The run's metrics. Every stage and external call records into this one, so
+# instrumented code does not need a Metrics passed down to it.
+metrics = Metrics()
+
+
+# cProfile only profiles the thread it is enabled on, and stages and their
+# workers run on threads of their own, so every thread started during the run
+# gets a profiler too. Their stats are merged with the calling thread's.
+class _ThreadProfiles:
+    def __init__(self) -> None:
+        self.__lock      = threading.Lock()
+        self.__profilers = [cProfile.Profile()]
+
+    def __start_thread(self, frame, event, arg) -> None:
+        profiler = cProfile.Profile()
+        with self.__lock:
+            self.__profilers.append(profiler)
+        profiler.enable()
+
+    def runcall(self, function: Callable[[], None]) -> None:
+        threading.setprofile(self.__start_thread)
+        try:
+            self.__profilers[0].runcall(function)
+        finally:
+            threading.setprofile(None)
+
+    def stats(self) -> pstats.Stats:
+        with self.__lock:
+            return pstats.Stats(*self.__profilers, stream = sys.stderr)
+
+
+# Runs `function`, under cProfile when a profile file is given, and writes the
+# metrics gathered even if the run fails part way through.
+def instrumented(function: Callable[[], None],
+                 prefix: str,
+                 metrics_file: Optional[str] = None,
+                 metrics_format: str = 'json',
+                 profile_file: Optional[str] = None) -> None:
+    profiles = _ThreadProfiles() if profile_file is not None else None
+    try:
+        if profiles is None:
+            function()
+        else:
+            profiles.runcall(function)
+    finally:
+        if profiles is not None:
+            stats = profiles.stats()
+            stats.dump_stats(profile_file)
+            stats.sort_stats('cumulative').print_stats(25)
+        if metrics_file is not None:
+            metrics.write(metrics_file, metrics_format, prefix)
@@ -1,19 +1,22 @@
+import re
+import string
 import urllib.parse
 from collections import namedtuple
-from typing import Iterable
+from typing import Dict, Iterable, List, Optional, Tuple
 from toolz.functoolz import partial
 
-import premailer
-import pystache
-from wedding.model import Party
+from wedding.model import Party, Guest
 
 
 Invitation = namedtuple(
     'Invitation',
-    ['recipient', 'subject', 'message']
+    ['recipient', 'subject', 'message', 'guest_id']
 )
 
 
+INVITATION_SUBJECT = 'Jenny and Jesse are Getting Married!'
+
+
 def _url_sub(field: str,
              value: str,
              url  : str) -> str:
@@ -27,6 +30,32 @@ _substitute_party = partial(_url_sub, '{partyId}')
 _substitute_guest = partial(_url_sub, '{guestId}')
 
 
+def _body_context(party: Party,
+                  guest: Guest,
+                  invitation_url: str,
+                  envelope_url: str) -> Dict[str, str]:
+    return {
+        'partyName'    : party.title ,
+        'invitationUrl': _substitute_guest(guest.id, invitation_url),
+        'envelopeUrl'  : envelope_url
+    }
+
+
+# premailer takes a good part of a second to import, so it is only imported
+# by runs that actually render email bodies.
+def _render_body(body_template: str,
+                 context: Dict[str, str]) -> str:
+    import premailer
+    import pystache
+
+    return premailer.transform(
+        pystache.render(
+            body_template,
+            context
+        )
+    )
+
+
 def build_invitations(invitation_template: str,
                       body_template: str,
                       envelope_template: str,
@@ -37,18 +66,132 @@ def build_invitations(invitation_template: str,
     return (
         Invitation(
             guest.email,
-            'Jenny and Jesse are Getting Married!',
-            premailer.transform(
-                pystache.render(
-                    body_template,
-                    {
-                        'partyName'    : party.title ,
-                        'invitationUrl': _substitute_guest(guest.id, invitation_url),
-                        'envelopeUrl'  : envelope_url
-                    }
-                )
-            )
+            INVITATION_SUBJECT,
+            _render_body(
+                body_template,
+                _body_context(party, guest, invitation_url, envelope_url)
+            ),
+            guest.id
         )
         for guest in party.guests
         if guest.email is not None
     )
+
+
+_FIELDS = ['partyName', 'invitationUrl', 'envelopeUrl']
+
+# Characters that pass through lxml's HTML serializer untouched (other than
+# '&') both in text and in URI attributes.
+_SAFE_ATTRIBUTE_CHARS = frozenset(string.ascii_letters + string.digits + '-_.~!*()#$%&+,/:;=?@[]')
+
+_PROBE_CONTEXT = {
+    'partyName'    : 'Probe & <Party>',
+    'invitationUrl': 'https://example.com/invitation?party=p&guest=g',
+    'envelopeUrl'  : 'https://example.com/envelopes/p.png'
+}
+
+
+def _placeholder(field: str) -> str:
+    return f'invitationplaceholder{field}end'
+
+
+def _escape_text(value: str) -> Optional[str]:
+    if any(ord(c) < 32 or 127 <= ord(c) < 160 for c in value):
+        return None
+    return value.replace('&', '&amp;').replace('<', '&lt;').replace('>', '&gt;')
+
+
+def _escape_attribute(value: str) -> Optional[str]:
+    if not all(c in _SAFE_ATTRIBUTE_CHARS for c in value):
+        return None
+    return value.replace('&', '&amp;')
+
+
+_Segment = namedtuple(
+    '_Segment',
+    ['literal', 'field', 'in_attribute']
+)
+
+
+def _compile_segments(body_template: str) -> Optional[List[_Segment]]:
+    placeholders = {_placeholder(field): field for field in _FIELDS}
+    if any(placeholder in body_template for placeholder in placeholders):
+        return None
+
+    transformed = _render_body(body_template, {field: _placeholder(field) for field in _FIELDS})
+    pieces      = re.split('(' + '|'.join(map(re.escape, placeholders)) + ')', transformed)
+
+    segments = []
+    prefix   = ''
+    for literal, placeholder in zip(pieces[0::2], pieces[1::2] + [None]):
+        prefix += literal
+        segments.append(_Segment(
+            literal,
+            placeholders.get(placeholder),
+            prefix.rfind('<') > prefix.rfind('>')
+        ))
+        prefix += placeholder or ''
+
+    return segments
+
+
+def _render_segments(segments: List[_Segment],
+                     context: Dict[str, str]) -> Optional[str]:
+    escaped = {}
+    for field in _FIELDS:
+        escaped[(field, False)] = _escape_text(context[field])
+        escaped[(field, True )] = _escape_attribute(context[field])
+
+    parts = []
+    for segment in segments:
+        parts.append(segment.literal)
+        if segment.field is not None:
+            value = escaped[(segment.field, segment.in_attribute)]
+            if value is None:
+                return None
+            parts.append(value)
+
+    return ''.join(parts)
+
+
+# Same output as build_invitations, but the body template is rendered and its
+# CSS inlined once; guests are then filled in by plain string substitution.
+class InvitationRenderer:
+    def __init__(self,
+                 invitation_template: str,
+                 body_template: str,
+                 envelope_template: str) -> None:
+        self.__invitation_template = invitation_template
+        self.__body_template       = body_template
+        self.__envelope_template   = envelope_template
+        self.__segments            = _compile_segments(body_template)
+
+        if self.__segments is not None and \
+           _render_segments(self.__segments, _PROBE_CONTEXT) != _render_body(body_template, _PROBE_CONTEXT):
+            self.__segments = None
+
+    def __body(self, context: Dict[str, str]) -> str:
+        body = (
+            None if self.__segments is None else
+            _render_segments(self.__segments, context)
+        )
+        return body if body is not None else _render_body(self.__body_template, context)
+
+    def __call__(self, party: Party) -> List[Invitation]:
+        invitation_url = _substitute_party(party.id, self.__invitation_template)
+        envelope_url   = _substitute_party(party.id, self.__envelope_template)
+
+        return [
+            Invitation(
+                guest.email,
+                INVITATION_SUBJECT,
+                self.__body(_body_context(party, guest, invitation_url, envelope_url)),
+                guest.id
+            )
+            for guest in party.guests
+            if guest.email is not None
+        ]
+
+    def render_all(self,
+                   parties: Iterable[Party]) -> Iterable[Tuple[Party, List[Invitation]]]:
+        return ((party, self(party)) for party in parties)
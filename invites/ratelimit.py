@@ -0,0 +1,128 @@
+import random
+import threading
+import time
+from email.utils import parsedate_to_datetime
+from typing import Callable, Optional, TypeVar
+
+T = TypeVar('T')
+
+
+class Clock:
+    def now(self) -> float:
+        return time.monotonic()
+
+    def sleep(self, seconds: float) -> None:
+        time.sleep(seconds)
+
+
+SYSTEM_CLOCK = Clock()
+
+
+# Lets calls through at `rate` cost units per second on average, with bursts
+# of up to `burst` units. Callers take their tokens up front and then sleep
+# off any deficit, so waiting callers queue in arrival order without holding
+# the lock.
+class TokenBucket:
+    def __init__(self,
+                 rate: float,
+                 burst: Optional[float] = None,
+                 clock: Clock = SYSTEM_CLOCK) -> None:
+        self.__rate    = rate
+        self.__burst   = burst if burst is not None else rate
+        self.__clock   = clock
+        self.__lock    = threading.Lock()
+        self.__tokens  = self.__burst
+        self.__updated = clock.now()
+
+    def acquire(self, cost: float = 1.0) -> float:
+        with self.__lock:
+            now            = self.__clock.now()
+            self.__tokens  = min(self.__burst, self.__tokens + (now - self.__updated) * self.__rate)
+            self.__updated = now
+            self.__tokens -= cost
+            wait           = -self.__tokens / self.__rate if self.__tokens < 0 else 0.0
+
+        if wait > 0:
+            self.__clock.sleep(wait)
+        return wait
+
+
+def parse_retry_after(value: Optional[str]) -> float:
+    if value is None:
+        return 0.0
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return 0.0
+
+
+# Error codes AWS uses when a request is rejected for exceeding a rate or
+# throughput limit, rather than failing.
+_AWS_THROTTLING_CODES = frozenset([
+    'ProvisionedThroughputExceededException',
+    'RequestLimitExceeded',
+    'SlowDown',
+    'Throttling',
+    'ThrottlingException',
+    'TooManyRequestsException'
+])
+
+
+# Recognizes botocore's ClientError by its response, so botocore need not be
+# imported to classify errors.
+def aws_retry_after(exc: Exception) -> Optional[float]:
+    response = getattr(exc, 'response', None)
+    if not isinstance(response, dict) or response.get('Error', {}).get('Code') not in _AWS_THROTTLING_CODES:
+        return None
+    return parse_retry_after(response.get('ResponseMetadata', {}).get('HTTPHeaders', {}).get('retry-after'))
+
+
+# Full-jitter exponential backoff: the n-th retry waits a random time of up to
+# base * 2^n seconds (capped), but never less than the server's Retry-After.
+class Backoff:
+    def __init__(self,
+                 base: float = 0.5,
+                 cap: float = 32.0,
+                 max_attempts: int = 8,
+                 clock: Clock = SYSTEM_CLOCK,
+                 jitter: Callable[[float, float], float] = random.uniform) -> None:
+        if max_attempts < 1:
+            raise ValueError(f'max_attempts must be at least 1, not {max_attempts}')
+        self.max_attempts = max_attempts
+        self.__base       = base
+        self.__cap        = cap
+        self.__clock      = clock
+        self.__jitter     = jitter
+
+    def delay(self, attempt: int, retry_after: float = 0.0) -> float:
+        return max(retry_after, self.__jitter(0, min(self.__cap, self.__base * 2 ** attempt)))
+
+    def sleep(self, attempt: int, retry_after: float = 0.0) -> None:
+        self.__clock.sleep(self.delay(attempt, retry_after))
+
+
+# Calls `function` under the rate limit, retrying it with backoff for as long
+# as `retry_after` recognizes the errors it raises as throttling (by returning
+# the server's Retry-After in seconds, or 0) and attempts remain.
+def call_with_retries(function: Callable[[], T],
+                      retry_after: Callable[[Exception], Optional[float]],
+                      limiter: Optional[TokenBucket] = None,
+                      backoff: Optional[Backoff] = None,
+                      cost: float = 1.0) -> T:
+    backoff = backoff or Backoff()
+    attempt = 0
+    while True:
+        if limiter is not None:
+            limiter.acquire(cost)
+        try:
+            return function()
+        except Exception as exc:
+            wait = retry_after(exc)
+            if wait is None or attempt + 1 >= backoff.max_attempts:
+                raise
+            backoff.sleep(attempt, wait)
+            attempt += 1
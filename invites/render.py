@@ -1,22 +1,199 @@
 import base64
+import hashlib
 import json
 import os
+import random
+import re
 import subprocess
+import sys
+import time
+from abc import ABC, abstractmethod
+from collections import namedtuple
+from concurrent.futures import ProcessPoolExecutor, as_completed
 from email.mime.multipart import MIMEMultipart
 from email.mime.text import MIMEText
 from tempfile import TemporaryDirectory
-from typing import Iterable, TextIO
+from typing import Any, Callable, Dict, Iterable, List, Optional, Set, TextIO, Tuple
 
 from wedding.model import EmailAddress, Party
 
+from invites.manifest import read_manifest, write_manifest
 from invites.model import Invitation
 
 
-class EnvelopeRenderer:
+RenderResult = namedtuple(
+    'RenderResult',
+    ['return_codes', 'failed', 'skipped']
+)
+
+
+RENDER_MANIFEST_FILE = '.render-manifest.json'
+
+_POLL_INTERVAL = 0.25
+
+# How long an envelope GIMP is still running on must stay unchanged before it
+# is taken as complete.
+_SETTLE_TIME = 2.0
+
+
+def _file_hash(digest, filename: str) -> None:
+    with open(filename, 'rb') as fin:
+        for chunk in iter(lambda: fin.read(1 << 16), b''):
+            digest.update(chunk)
+
+
+_ENVELOPE_EXTENSIONS = ['.png', '.jpg', '.jpeg', '.gif']
+
+
+# Shards recipients across workers and skips parties whose envelope is still
+# current. Subclasses render one shard per worker and return its exit code,
+# calling _rendered for each recipient as soon as its envelope is complete.
+class _CachingEnvelopeRenderer(ABC):
+    def __init__(self,
+                 output_dir: str,
+                 workers   : int,
+                 force     : bool) -> None:
+        self.__output_dir  = os.path.abspath(output_dir)
+        self.__workers     = workers
+        self.__force       = force
+        self.__before      = {}     # type: Dict[str, float]
+        self.__on_rendered = None   # type: Optional[Callable[[Party, str], None]]
+        self.__signalled   = set()  # type: Set[str]
+
+    @abstractmethod
+    def _template_hash(self) -> str:
+        pass
+
+    @abstractmethod
+    def _render_shards(self, shards: List[List[Party]]) -> List[int]:
+        pass
+
+    def __envelope_file(self, party_id: str) -> Optional[Tuple[str, float]]:
+        for extension in _ENVELOPE_EXTENSIONS:
+            envelope_file = os.path.join(self.__output_dir, party_id + extension)
+            try:
+                return envelope_file, os.stat(envelope_file).st_mtime
+            except FileNotFoundError:
+                pass
+        return None
+
+    # The size and modification time of an envelope written during this run,
+    # or None if the recipient has none yet.
+    def _rendered_stat(self, recipient: Party) -> Optional[Tuple[int, float]]:
+        envelope = self.__envelope_file(recipient.id)
+        if envelope is None or self.__before.get(recipient.id) == envelope[1]:
+            return None
+        try:
+            stat = os.stat(envelope[0])
+        except FileNotFoundError:
+            return None
+        return stat.st_size, stat.st_mtime
+
+    def _rendered(self, recipient: Party) -> None:
+        if self.__on_rendered is None or recipient.id in self.__signalled:
+            return
+        envelope = self.__envelope_file(recipient.id)
+        if envelope is not None and self.__before.get(recipient.id) != envelope[1]:
+            self.__signalled.add(recipient.id)
+            self.__on_rendered(recipient, envelope[0])
+
+    def __output_mtimes(self) -> Dict[str, float]:
+        return {
+            os.path.splitext(entry.name)[0]: entry.stat().st_mtime
+            for entry in os.scandir(self.__output_dir)
+            if entry.is_file()
+        }
+
+    # An envelope depends only on the template and the party's title, so a
+    # party is rendered again only if either changed or its envelope did.
+    def __is_current(self,
+                     entry: dict,
+                     template_hash: str,
+                     recipient: Party,
+                     mtimes: Dict[str, float]) -> bool:
+        return \
+            entry.get('template') == template_hash and \
+            entry.get('title') == recipient.title and \
+            entry.get('mtime') == mtimes.get(recipient.id)
+
+    # on_current is called with each party whose envelope is still current
+    # before anything is rendered, so it can be used without waiting.
+    def __call__(self,
+                 recipients: Iterable[Party],
+                 on_rendered: Optional[Callable[[Party, str], None]] = None,
+                 on_current: Optional[Callable[[Party, str], None]] = None) -> RenderResult:
+        if not os.path.exists(self.__output_dir):
+            os.makedirs(self.__output_dir)
+
+        manifest_file = os.path.join(self.__output_dir, RENDER_MANIFEST_FILE)
+        manifest      = read_manifest(manifest_file)
+        template_hash = self._template_hash()
+        before        = self.__output_mtimes()
+
+        self.__before      = before
+        self.__on_rendered = on_rendered
+        self.__signalled   = set()
+
+        # Forcing renders every recipient of this run again, but the manifest
+        # entries of parties not rendered now are kept for later runs.
+        recipients = list(recipients)
+        skipped    = [
+            recipient
+            for recipient in recipients
+            if not self.__force and
+               self.__is_current(manifest.get(recipient.id, {}), template_hash, recipient, before)
+        ]
+        if on_current is not None:
+            for recipient in skipped:
+                envelope = self.__envelope_file(recipient.id)
+                if envelope is not None:
+                    on_current(recipient, envelope[0])
+
+        skipped_ids = set(recipient.id for recipient in skipped)
+        outdated    = [recipient for recipient in recipients if recipient.id not in skipped_ids]
+        shards      = [
+            shard
+            for shard in (outdated[index::self.__workers] for index in range(self.__workers))
+            if shard
+        ]
+
+        return_codes = self._render_shards(shards)
+
+        # A party rendered only if its envelope was written during this run.
+        after  = self.__output_mtimes()
+        failed = [
+            recipient
+            for shard, return_code in zip(shards, return_codes)
+            for recipient in shard
+            if return_code != 0 or
+               recipient.id not in after or
+               before.get(recipient.id) == after[recipient.id]
+        ]
+        failed_ids = set(recipient.id for recipient in failed)
+
+        for recipient in outdated:
+            if recipient.id in failed_ids:
+                manifest.pop(recipient.id, None)
+            else:
+                self._rendered(recipient)
+                manifest[recipient.id] = {
+                    'template': template_hash,
+                    'title'   : recipient.title,
+                    'mtime'   : after[recipient.id]
+                }
+        write_manifest(manifest_file, manifest)
+
+        return RenderResult(return_codes, failed, skipped)
+
+
+class EnvelopeRenderer(_CachingEnvelopeRenderer):
     def __init__(self,
                  gimp_path    : str,
                  template_file: str,
-                 output_dir   : str) -> None:
+                 output_dir   : str,
+                 workers      : int = 1,
+                 force        : bool = False) -> None:
+        super().__init__(output_dir, workers, force)
         self.__gimp_path     = os.path.abspath(gimp_path)
         self.__template_file = os.path.abspath(template_file)
         self.__output_dir    = os.path.abspath(output_dir)
@@ -44,38 +221,275 @@ class EnvelopeRenderer:
             --batch '(python-fu-invite-gen RUN-NONINTERACTIVE {args})' \\
             --batch '(gimp-quit 1)'"""
 
-    def __call__(self, recipients: Iterable[Party]) -> int:
-        if not os.path.exists(self.__output_dir):
-            os.makedirs(self.__output_dir)
+    def _template_hash(self) -> str:
+        digest = hashlib.sha256()
+        _file_hash(digest, self.__template_file)
+        return digest.hexdigest()
 
+    def _render_shards(self, shards: List[List[Party]]) -> List[int]:
         with TemporaryDirectory() as tmpdirname:
-            recipients_file = os.path.join(tmpdirname, 'recipients.json')
+            processes = []
+
+            for index, shard in enumerate(shards):
+                recipients_file = os.path.join(tmpdirname, f'recipients-{index}.json')
+
+                with open(recipients_file, 'w') as fout:
+                    self.write_recipients_file(shard, fout)
+
+                processes.append(subprocess.Popen(
+                    self.__command(recipients_file),
+                    shell = True
+                ))
+
+            # GIMP writes envelopes in place, so while it runs an envelope is
+            # only taken as complete once the plugin has moved on to the next
+            # recipient and the envelope's size and modification time have not
+            # changed for _SETTLE_TIME. The rest are reported once GIMP exits.
+            seen     = {}     # type: Dict[str, Tuple[Tuple[int, float], float]]
+            finished = set()  # type: Set[str]
+            while any(process.poll() is None for process in processes):
+                now = time.monotonic()
+                for shard in shards:
+                    for recipient, following in zip(shard, shard[1:]):
+                        if recipient.id in finished:
+                            continue
+                        stat = self._rendered_stat(recipient)
+                        if stat is None:
+                            break
+                        if recipient.id not in seen or seen[recipient.id][0] != stat:
+                            seen[recipient.id] = (stat, now)
+                        elif now - seen[recipient.id][1] >= _SETTLE_TIME and \
+                             self._rendered_stat(following) is not None:
+                            self._rendered(recipient)
+                            finished.add(recipient.id)
+                time.sleep(_POLL_INTERVAL)
+
+            return [process.wait() for process in processes]
+
+
+EnvelopeStyle = namedtuple(
+    'EnvelopeStyle',
+    ['font_file', 'font_size', 'position', 'color']
+)
+
+
+# Loaded once per worker process by _load_native_envelope.
+_native_envelope = {}  # type: Dict[str, Any]
 
-            with open(recipients_file, 'w') as fout:
-                self.write_recipients_file(recipients, fout)
 
-            completed = subprocess.run(
-                self.__command(recipients_file),
-                shell = True
-            )
+def _load_native_envelope(base_image: str,
+                          style: EnvelopeStyle) -> None:
+    from PIL import Image, ImageFont
 
-            return completed.returncode
+    with Image.open(base_image) as image:
+        _native_envelope['base'] = image.convert('RGBA')
+    _native_envelope['font'] = (
+        ImageFont.load_default() if style.font_file is None else
+        ImageFont.truetype(style.font_file, style.font_size)
+    )
+
+
+def _text_size(draw, text: str, font) -> Tuple[int, int]:
+    if hasattr(draw, 'textbbox'):
+        left, top, right, bottom = draw.textbbox((0, 0), text, font = font)
+        return right - left, bottom - top
+    return draw.textsize(text, font = font)
+
+
+def _draw_native_envelope(style: EnvelopeStyle,
+                          output_dir: str,
+                          recipient: Tuple[str, str]) -> None:
+    from PIL import ImageDraw
+
+    party_id, title = recipient
+    envelope        = _native_envelope['base'].copy()
+    draw            = ImageDraw.Draw(envelope)
+    width, height   = _text_size(draw, title, _native_envelope['font'])
+    x, y            = style.position
+
+    draw.text(
+        (x * envelope.width - width / 2, y * envelope.height - height / 2),
+        title,
+        font = _native_envelope['font'],
+        fill = style.color
+    )
+
+    # Written under a temporary name first so a partial file is never seen as an envelope.
+    partial_file = os.path.join(output_dir, f'.{party_id}.png.partial')
+    envelope.save(partial_file, format = 'PNG')
+    os.replace(partial_file, os.path.join(output_dir, f'{party_id}.png'))
+
+
+def _render_native_envelope(base_image: str,
+                            style: EnvelopeStyle,
+                            output_dir: str,
+                            recipient: Tuple[str, str]) -> bool:
+    try:
+        if not _native_envelope:
+            _load_native_envelope(base_image, style)
+        _draw_native_envelope(style, output_dir, recipient)
+    except Exception as exc:
+        print(f'Unable to draw envelope for party {recipient[0]} ({recipient[1]}): {exc}')
+        return False
+    return True
+
+
+# Draws the party title onto a flattened envelope image with Pillow, in
+# worker processes, instead of starting GIMP. The base image must be in a
+# format Pillow reads (e.g. a PNG exported from Envelope-Flattened.xcf).
+class NativeEnvelopeRenderer(_CachingEnvelopeRenderer):
+    def __init__(self,
+                 base_image: str,
+                 style     : EnvelopeStyle,
+                 output_dir: str,
+                 workers   : int = 1,
+                 force     : bool = False) -> None:
+        super().__init__(output_dir, workers, force)
+        self.__base_image = os.path.abspath(base_image)
+        self.__style      = style
+        self.__output_dir = os.path.abspath(output_dir)
+
+    def _template_hash(self) -> str:
+        digest = hashlib.sha256()
+        _file_hash(digest, self.__base_image)
+        if self.__style.font_file is not None:
+            _file_hash(digest, self.__style.font_file)
+        digest.update(repr(tuple(self.__style)).encode('utf-8'))
+        return digest.hexdigest()
+
+    def _render_shards(self, shards: List[List[Party]]) -> List[int]:
+        if not shards:
+            return []
+
+        return_codes = [0] * len(shards)
+
+        with ProcessPoolExecutor(max_workers = len(shards)) as executor:
+            renders = {
+                executor.submit(
+                    _render_native_envelope,
+                    self.__base_image,
+                    self.__style,
+                    self.__output_dir,
+                    (recipient.id, recipient.title)
+                ): (index, recipient)
+                for index, shard in enumerate(shards)
+                for recipient in shard
+            }
+
+            for render in as_completed(renders):
+                index, recipient = renders[render]
+                if render.result():
+                    self._rendered(recipient)
+                else:
+                    return_codes[index] = 1
+
+        return return_codes
 
 
 def email_address(address: EmailAddress) -> str:
     return f'{address.username}@{address.hostname}'
 
 
-def base64_email(sender: EmailAddress,
-                 invitation: Invitation) -> str:
-    message = MIMEMultipart()
-    message['to'] = email_address(invitation.recipient)
-    message['from'] = email_address(sender)
-    message['subject'] = invitation.subject
-    message.preamble = """
+_PREAMBLE = """
     Your mail reader does not support HTML.
     Please visit us <a href="http://www.mysite.com">online</a>!
     """
-    message.attach(MIMEText(invitation.message, _subtype='html'))
 
-    return base64.urlsafe_b64encode(message.as_string().encode('ascii')).decode('ascii')
+
+# Drafts carry the id of the guest they invite, so they can be found and sent
+# later without rendering them again.
+GUEST_HEADER = 'X-Invitation-Guest'
+
+
+def _mime_message(sender: str,
+                  recipient: str,
+                  guest_id: str,
+                  subject: str,
+                  body: str) -> MIMEMultipart:
+    message = MIMEMultipart()
+    message['to'] = recipient
+    message[GUEST_HEADER] = guest_id
+    message['from'] = sender
+    message['subject'] = subject
+    message.preamble = _PREAMBLE
+    message.attach(MIMEText(body, _subtype='html'))
+    return message
+
+
+def base64_email(sender: EmailAddress,
+                 invitation: Invitation) -> str:
+    message = _mime_message(
+        email_address(sender),
+        email_address(invitation.recipient),
+        invitation.guest_id,
+        invitation.subject,
+        invitation.message
+    )
+
+    return base64.urlsafe_b64encode(message.as_string().encode('utf-8')).decode('ascii')
+
+
+# Header values the email package writes out unchanged: printable ASCII,
+# short enough that the header is never folded.
+_PLAIN_HEADER = re.compile(r'[!-~]{1,72}\Z')
+
+_TO_PLACEHOLDER    = 'recipient.placeholder@invalid'
+_GUEST_PLACEHOLDER = 'guestplaceholder'
+_BODY_PLACEHOLDER  = 'bodyplaceholder'
+
+_MessageSkeleton = namedtuple(
+    '_MessageSkeleton',
+    ['before_to', 'before_guest', 'before_ascii_body', 'before_utf8_body', 'after_body']
+)
+
+
+# Builds the same messages as base64_email, but serializes the headers and
+# part structure once per subject and only fills in the recipient and body.
+# ASCII bodies are sent 7bit exactly as before; others as base64 UTF-8.
+class MessageBuilder:
+    def __init__(self, sender: EmailAddress) -> None:
+        self.__address   = sender
+        self.__sender    = email_address(sender)
+        self.__boundary  = '=' * 15 + f'{random.randrange(sys.maxsize):019d}' + '=='
+        self.__skeletons = {}  # type: Dict[str, _MessageSkeleton]
+
+    def __skeleton(self, subject: str) -> _MessageSkeleton:
+        if subject not in self.__skeletons:
+            message = _mime_message(self.__sender, _TO_PLACEHOLDER, _GUEST_PLACEHOLDER, subject, _BODY_PLACEHOLDER)
+            message.set_boundary(self.__boundary)
+
+            before_to, rest               = message.as_string().split(_TO_PLACEHOLDER)
+            before_guest, rest            = rest.split(_GUEST_PLACEHOLDER)
+            before_ascii_body, after_body = rest.split(_BODY_PLACEHOLDER)
+            before_utf8_body              = before_ascii_body \
+                .replace('charset="us-ascii"', 'charset="utf-8"') \
+                .replace('Content-Transfer-Encoding: 7bit', 'Content-Transfer-Encoding: base64')
+
+            self.__skeletons[subject] = _MessageSkeleton(before_to, before_guest, before_ascii_body, before_utf8_body, after_body)
+        return self.__skeletons[subject]
+
+    def __call__(self, invitation: Invitation) -> str:
+        recipient = email_address(invitation.recipient)
+        body      = invitation.message
+
+        if self.__boundary in body or '\r' in body \
+                or not _PLAIN_HEADER.match(recipient) \
+                or not _PLAIN_HEADER.match(invitation.guest_id):
+            return base64_email(self.__address, invitation)
+
+        skeleton = self.__skeleton(invitation.subject)
+        try:
+            body.encode('ascii')
+            before_body = skeleton.before_ascii_body
+        except UnicodeEncodeError:
+            body        = base64.encodebytes(body.encode('utf-8')).decode('ascii')
+            before_body = skeleton.before_utf8_body
+
+        return base64.urlsafe_b64encode(
+            ''.join([
+                skeleton.before_to, recipient,
+                skeleton.before_guest, invitation.guest_id,
+                before_body, body,
+                skeleton.after_body
+            ]).encode('utf-8')
+        ).decode('ascii')
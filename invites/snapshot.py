@@ -0,0 +1,130 @@
+import gzip
+import json
+import os
+import threading
+from collections import OrderedDict
+from typing import Callable, Dict, Iterable, List, Optional, Tuple
+
+from toolz import partition_all
+from wedding.general.store import Store
+from wedding.model import Party, PartyCodec
+
+from invites.manifest import read_manifest, write_manifest
+
+
+# Serves every read in a run from memory: the table is scanned at most once,
+# and each party fetched individually is fetched at most once. Writes go
+# straight through to the wrapped store and are mirrored in memory. Stages
+# running concurrently share one snapshot, so calls into the wrapped store
+# (whose table resource is not thread-safe) are made one at a time.
+class PartySnapshot(Store[str, Party]):
+    def __init__(self, store: Store[str, Party]) -> None:
+        self.__store    = store
+        self.__lock     = threading.RLock()
+        self.__parties  = OrderedDict()  # type: Dict[str, Optional[Party]]
+        self.__complete = False
+
+    def get_all(self) -> Iterable[Party]:
+        with self.__lock:
+            if not self.__complete:
+                self.__parties  = OrderedDict((party.id, party) for party in self.__store.get_all())
+                self.__complete = True
+            return list(self.__parties.values())
+
+    def get(self, key: str) -> Optional[Party]:
+        with self.__lock:
+            if key not in self.__parties and not self.__complete:
+                self.__parties[key] = self.__store.get(key)
+            return self.__parties.get(key)
+
+    def put(self, party: Party) -> None:
+        with self.__lock:
+            self.__store.put(party)
+            self.__parties[party.id] = party
+
+    def modify(self, key: str, modifier: Callable[[Party], Party]):
+        with self.__lock:
+            result = self.__store.modify(key, modifier)
+            if self.__parties.get(key) is not None:
+                self.__parties[key] = modifier(self.__parties[key])
+            return result
+
+
+# Snapshot files are gzip-compressed JSON lines of PartyCodec-encoded
+# parties, compressed in independent blocks. The index next to the file
+# gives each block's offset and each party's block and line, so a single
+# party is found by decompressing one block rather than the whole file.
+_BLOCK_PARTIES = 256
+
+
+def _index_file(snapshot_file: str) -> str:
+    return snapshot_file + '.index'
+
+
+def write_snapshot(snapshot_file: str,
+                   parties: Iterable[Party]) -> int:
+    blocks        = []  # type: List[int]
+    parties_index = {}  # type: Dict[str, List[int]]
+
+    with open(snapshot_file + '.tmp', 'wb') as fout:
+        for block, block_parties in enumerate(partition_all(_BLOCK_PARTIES, parties)):
+            blocks.append(fout.tell())
+            lines = []
+            for line, party in enumerate(block_parties):
+                parties_index[party.id] = [block, line]
+                lines.append(json.dumps(PartyCodec.encode(party)) + '\n')
+            fout.write(gzip.compress(''.join(lines).encode('utf-8')))
+        size = fout.tell()
+
+    os.replace(snapshot_file + '.tmp', snapshot_file)
+    write_manifest(_index_file(snapshot_file), { 'size': size, 'blocks': blocks, 'parties': parties_index })
+    return len(parties_index)
+
+
+def read_snapshot(snapshot_file: str) -> Iterable[Party]:
+    with gzip.open(snapshot_file, 'rt', encoding = 'utf-8') as fin:
+        for line in fin:
+            yield PartyCodec.decode(json.loads(line))
+
+
+# Reads parties from a snapshot file. The file is a copy of the table, so it
+# cannot be written to; rsvp stages are saved to the table by
+# RsvpStageUpdater.
+class SnapshotStore(Store[str, Party]):
+    def __init__(self, snapshot_file: str) -> None:
+        self.__snapshot_file = snapshot_file
+        self.__index         = None  # type: Optional[dict]
+        self.__block         = (None, [])  # type: Tuple[Optional[int], List[str]]
+
+    def __load_index(self) -> dict:
+        if self.__index is None:
+            self.__index = read_manifest(_index_file(self.__snapshot_file))
+            if self.__index.get('size') != os.path.getsize(self.__snapshot_file):
+                raise ValueError(f'{_index_file(self.__snapshot_file)} does not match {self.__snapshot_file}')
+        return self.__index
+
+    def __block_lines(self, block: int) -> List[str]:
+        if self.__block[0] != block:
+            index = self.__load_index()
+            start = index['blocks'][block]
+            end   = index['blocks'][block + 1] if block + 1 < len(index['blocks']) else index['size']
+            with open(self.__snapshot_file, 'rb') as fin:
+                fin.seek(start)
+                self.__block = (block, gzip.decompress(fin.read(end - start)).decode('utf-8').splitlines())
+        return self.__block[1]
+
+    def get_all(self) -> Iterable[Party]:
+        return read_snapshot(self.__snapshot_file)
+
+    def get(self, key: str) -> Optional[Party]:
+        location = self.__load_index()['parties'].get(key)
+        if location is None:
+            return None
+        block, line = location
+        return PartyCodec.decode(json.loads(self.__block_lines(block)[line]))
+
+    def put(self, party: Party) -> None:
+        raise ValueError(f'{self.__snapshot_file} is a read-only party snapshot')
+
+    def modify(self, key: str, modifier: Callable[[Party], Party]):
+        raise ValueError(f'{self.__snapshot_file} is a read-only party snapshot')
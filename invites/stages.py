@@ -0,0 +1,134 @@
+import threading
+import time
+import traceback
+from collections import namedtuple
+from concurrent.futures import FIRST_COMPLETED, Future, ThreadPoolExecutor, wait
+from typing import Callable, Dict, Iterable, List, Optional, Set
+
+from invites.metrics import metrics
+
+
+Stage = namedtuple(
+    'Stage',
+    ['name', 'run', 'after']
+)
+
+StageResult = namedtuple(
+    'StageResult',
+    ['name', 'seconds', 'error', 'skipped']
+)
+
+
+def stage(name: str,
+          run: Callable[[], None],
+          after: Iterable[str] = ()) -> Stage:
+    return Stage(name, run, frozenset(after))
+
+
+def _run_stage(to_run: Stage) -> StageResult:
+    start = time.perf_counter()
+    try:
+        with metrics.stage(to_run.name):
+            to_run.run()
+    except Exception as exc:
+        print(f'Stage {to_run.name} failed:')
+        traceback.print_exc()
+        return StageResult(to_run.name, time.perf_counter() - start, exc, False)
+    return StageResult(to_run.name, time.perf_counter() - start, None, False)
+
+
+# Runs every stage on its own thread as soon as the stages it comes after have
+# finished. A stage that fails is reported with its error and the stages after
+# it are skipped; stages that do not depend on it still run to completion.
+# On Ctrl-C, `cancelled` is set for the running stages to notice, no further
+# stages are started, and the interrupt is raised once the running ones end.
+def run_stages(stages: List[Stage],
+               cancelled: Optional[threading.Event] = None) -> List[StageResult]:
+    cancelled   = cancelled or threading.Event()
+    interrupted = None  # type: Optional[KeyboardInterrupt]
+    results     = {}    # type: Dict[str, StageResult]
+    waiting     = list(stages)
+    running     = {}    # type: Dict[Future, Stage]
+
+    with ThreadPoolExecutor(max_workers = max(1, len(stages))) as executor:
+        while waiting or running:
+            for pending in list(waiting):
+                if not pending.after <= set(results):
+                    continue
+                waiting.remove(pending)
+                blocked = [name for name in pending.after if results[name].error is not None or results[name].skipped]
+                if blocked or cancelled.is_set():
+                    reason = 'the run was cancelled' if cancelled.is_set() else f'{", ".join(sorted(blocked))} did not finish'
+                    print(f'Skipping stage {pending.name} because {reason}')
+                    results[pending.name] = StageResult(pending.name, 0.0, None, True)
+                else:
+                    running[executor.submit(_run_stage, pending)] = pending
+
+            if not running:
+                if waiting:
+                    raise ValueError(f'Stages {[pending.name for pending in waiting]} depend on unknown stages')
+                break
+
+            try:
+                done, _ = wait(running, return_when = FIRST_COMPLETED)
+            except KeyboardInterrupt as exc:
+                print(f'Cancelling; waiting for stages {", ".join(sorted(s.name for s in running.values()))} to stop')
+                interrupted = exc
+                cancelled.set()
+                continue
+
+            for future in done:
+                results[running.pop(future).name] = future.result()
+
+    if interrupted is not None:
+        raise interrupted
+
+    for result in results.values():
+        if not result.skipped:
+            print(f'Stage {result.name} {"failed" if result.error is not None else "finished"} after {result.seconds:.1f}s')
+
+    return [results[pending.name] for pending in stages]
+
+
+# Holds sending a party's invitations until its envelope has been uploaded.
+# Every waiter is released once the envelope stage is over, whether or not
+# that party's envelope made it. Waiters are called back rather than blocked,
+# on the thread that reports the upload (or closes the barrier), so they
+# should only hand the party on.
+class EnvelopeBarrier:
+    def __init__(self) -> None:
+        self.__lock     = threading.Lock()
+        self.__uploaded = set()  # type: Set[str]
+        self.__waiting  = {}     # type: Dict[str, List[Callable[[bool], None]]]
+        self.__closed   = False
+
+    def uploaded(self, party_id: str) -> None:
+        with self.__lock:
+            self.__uploaded.add(party_id)
+            released = self.__waiting.pop(party_id, [])
+        for callback in released:
+            callback(True)
+
+    def close(self) -> None:
+        with self.__lock:
+            self.__closed = True
+            released      = [
+                (party_id in self.__uploaded, callback)
+                for party_id, callbacks in self.__waiting.items()
+                for callback in callbacks
+            ]
+            self.__waiting = {}
+        for uploaded, callback in released:
+            callback(uploaded)
+
+    # Calls `callback` with whether the party's envelope was uploaded, now if
+    # that is already known and otherwise once it is.
+    def when_uploaded(self,
+                      party_id: str,
+                      callback: Callable[[bool], None]) -> None:
+        with self.__lock:
+            if party_id not in self.__uploaded and not self.__closed:
+                self.__waiting.setdefault(party_id, []).append(callback)
+                return
+            uploaded = party_id in self.__uploaded
+        callback(uploaded)
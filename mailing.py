@@ -1,113 +1,654 @@
-from wedding.model import party_store, Party, EmailSent
+# Taken before anything else is imported, so the reported startup time
+# includes the imports.
+import time
+_STARTED = time.perf_counter()
+
+from wedding.model import party_store, EmailAddress, Guest, Party, EmailSent
+from wedding.general.functional import option
 from wedding.general.store import Store
-import boto3
+import os
 import sys
-import traceback
+import threading
+from collections import Counter, deque, namedtuple
+from concurrent.futures import Future, ThreadPoolExecutor
+from email.utils import parseaddr
+from typing import Deque, Dict, Iterable, List, Optional, Tuple, TYPE_CHECKING
+from toolz.functoolz import partial
 
 from invites.cli import parse_arguments, Arguments
-from invites.model import build_invitations
-from invites.google import get_credentials, GmailService, gmail_service
-from invites.aws import upload_envelopes
+from invites.model import INVITATION_SUBJECT, InvitationRenderer
+from invites.google import get_credentials, draft_headers, BatchResult, GmailService, thread_local_gmail_service
+from invites.journal import MailingJournal, DRAFTED, SENT, FAILED
+from invites.metrics import instrumented, metrics
+from invites.ratelimit import TokenBucket
+from invites.snapshot import PartySnapshot, SnapshotStore
+from invites.stages import EnvelopeBarrier, run_stages, stage
 from invites import render
 
+if TYPE_CHECKING:
+    from invites.aws import RsvpStageUpdater
 
-def _create_envelopes(args: Arguments,
-                      parties: Store[str, Party]):
-    render_envelopes = render.EnvelopeRenderer(
+
+def _selected_parties(args: Arguments,
+                      parties: Store[str, Party]) -> Iterable[Party]:
+    with metrics.stage('load_parties'):
+        return parties.get_all() if len(args.only) == 0 else list(map(parties.get, args.only))
+
+
+# One sender's share of a run: the parties they invite, and a Gmail service
+# of their own, so every sender's quota is used independently.
+_Sender = namedtuple(
+    '_Sender',
+    ['address', 'parties', 'gmail']
+)
+
+
+# Groups the selected parties by inviter in a single pass. Without
+# --all-senders, only the parties of --sender are kept.
+def _parties_by_sender(args: Arguments,
+                       parties: Store[str, Party]) -> Dict[EmailAddress, List[Party]]:
+    if not args.all_senders:
+        return { args.sender: [party for party in _selected_parties(args, parties) if party.inviter == args.sender] }
+
+    by_sender = {}  # type: Dict[EmailAddress, List[Party]]
+    for party in _selected_parties(args, parties):
+        by_sender.setdefault(party.inviter, []).append(party)
+    return by_sender
+
+
+def _envelope_renderer(args: Arguments):
+    if args.envelope_engine == 'native':
+        return render.NativeEnvelopeRenderer(
+            args.envelope_base_image,
+            render.EnvelopeStyle(
+                args.envelope_font,
+                args.envelope_font_size,
+                args.envelope_text_position,
+                args.envelope_text_color
+            ),
+            args.envelopes_dir,
+            args.render_workers,
+            args.force
+        )
+
+    return render.EnvelopeRenderer(
         args.gimp_path,
         args.gimp_template,
-        args.envelopes_dir
+        args.envelopes_dir,
+        args.render_workers,
+        args.force
     )
 
-    render_envelopes(
-        parties.get_all() if len(args.only) == 0 else
-        map(parties.get, args.only)
+
+# boto3 is only imported by the stages that talk to AWS, so runs working
+# from a snapshot or skipping envelopes do not pay for importing it.
+def _party_table(table_name: str) -> Store[str, Party]:
+    import boto3
+
+    return party_store(boto3.resource('dynamodb').Table(table_name))
+
+
+# Rsvp stages are saved by RsvpStageUpdater, straight to --parties-table, so
+# runs reading a snapshot do not need the table for anything else.
+def _party_source(args: Arguments) -> Store[str, Party]:
+    if args.parties_snapshot is None:
+        return _party_table(args.parties_table)
+    if args.parties_table is None:
+        print(f'Reading parties from {args.parties_snapshot}; rsvp stage updates will not be saved without --parties-table')
+    return SnapshotStore(args.parties_snapshot)
+
+
+# Envelopes are uploaded as soon as each one is completely rendered, then the
+# rest of the directory is checked as before, except envelopes whose render
+# failed and may be incomplete.
+def _create_envelopes(args: Arguments,
+                      parties: Store[str, Party],
+                      barrier: Optional[EnvelopeBarrier] = None):
+    from invites.aws import EnvelopeUploader
+
+    def uploaded(result) -> None:
+        if barrier is not None and result.error is None:
+            barrier.uploaded(os.path.splitext(os.path.basename(result.filename))[0])
+
+    try:
+        _render_and_upload_envelopes(args, parties, EnvelopeUploader(
+            args.envelopes_dir,
+            args.resource_bucket,
+            args.envelope_prefix,
+            parties,
+            args.upload_workers,
+            args.force,
+            uploaded,
+            option.fmap(TokenBucket)(args.s3_rate)
+        ))
+    finally:
+        if barrier is not None:
+            barrier.close()
+
+
+def _render_and_upload_envelopes(args: Arguments,
+                                 parties: Store[str, Party],
+                                 uploader) -> None:
+    render_envelopes = _envelope_renderer(args)
+
+    def upload(party: Party, envelope_file: str) -> None:
+        metrics.count('envelopes_rendered')
+        uploader.upload(envelope_file)
+
+    # Envelopes that are still current are uploaded (or found unchanged) right
+    # away, so their parties' invitations need not wait for the render.
+    def upload_current(party: Party, envelope_file: str) -> None:
+        uploader.upload(envelope_file)
+
+    try:
+        selected = _selected_parties(args, parties)
+        with metrics.stage('render_envelopes'):
+            rendered = render_envelopes(selected, upload, upload_current)
+        metrics.count('envelopes_render_failed', len(rendered.failed))
+        metrics.count('envelopes_render_skipped', len(rendered.skipped))
+
+        if any(return_code != 0 for return_code in rendered.return_codes):
+            print(f'Envelope rendering exited with return codes {rendered.return_codes}')
+        for party in rendered.failed:
+            print(f'Unable to render envelope for party {party.id} ({party.title})')
+        print(f'Skipped rendering {len(rendered.skipped)} unchanged envelopes')
+
+        with metrics.stage('upload_envelopes'):
+            uploader.upload_directory(party.id for party in rendered.failed)
+    finally:
+        with metrics.stage('upload_envelopes'):
+            uploader.close()
+
+
+_Delivery = namedtuple(
+    '_Delivery',
+    ['party', 'guest_id', 'message', 'draft', 'delivered']
+)
+
+
+def _single_or_batch(single, batch, items: List) -> List[BatchResult]:
+    if not items:
+        return []
+    if len(items) > 1:
+        return batch(items)
+    try:
+        return [BatchResult(single(items[0]), None)]
+    except Exception as exc:
+        return [BatchResult(None, exc)]
+
+
+def _send_drafts(gmail: GmailService,
+                 journal: MailingJournal,
+                 created: List[_Delivery]) -> None:
+    sent = _single_or_batch(gmail.send, gmail.send_drafts, [delivery.draft for delivery in created])
+    for delivery, result in zip(created, sent):
+        party = delivery.party
+        if result.error is not None:
+            print(f'Unable to send email for party {party.id} ({party.title}): {result.error}')
+            metrics.count('emails_failed')
+            journal.record(party.id, delivery.guest_id, FAILED, draft_id = delivery.draft['id'], error = str(result.error))
+        else:
+            metrics.count('emails_sent')
+            journal.record(party.id, delivery.guest_id, SENT, draft_id = delivery.draft['id'])
+        delivery.delivered.set_result(result.error is None)
+
+
+# Sends drafts once their party's envelope has been uploaded, on threads of
+# its own, so creating drafts never waits for envelopes. Drafts released
+# together are sent together, in batches. Drafts of parties whose envelope
+# never was uploaded are kept, for a later --resume to send.
+class _HeldSends:
+    def __init__(self,
+                 args: Arguments,
+                 gmail: GmailService,
+                 journal: MailingJournal,
+                 barrier: EnvelopeBarrier) -> None:
+        self.__batch_size = args.batch_size
+        self.__gmail      = gmail
+        self.__journal    = journal
+        self.__barrier    = barrier
+        self.__lock       = threading.Lock()
+        self.__ready      = []  # type: List[_Delivery]
+        self.__executor   = ThreadPoolExecutor(max_workers = args.concurrency)
+
+    def add(self, created: List[_Delivery]) -> None:
+        for delivery in created:
+            self.__barrier.when_uploaded(
+                delivery.party.id,
+                partial(self.__released, delivery)
+            )
+
+    # Called back by the barrier, on the thread that uploaded the envelope,
+    # so the send itself is left to this class's own threads.
+    def __released(self,
+                   delivery: _Delivery,
+                   uploaded: bool) -> None:
+        party = delivery.party
+        if not uploaded:
+            print(f'Not sending invitation for party {party.id} ({party.title}) because its envelope was not uploaded')
+            metrics.count('emails_held')
+            delivery.delivered.set_result(False)
+            return
+
+        with self.__lock:
+            self.__ready.append(delivery)
+        try:
+            self.__executor.submit(self.__send_ready)
+        except RuntimeError:
+            # Released after the run stopped mailing.
+            delivery.delivered.set_result(False)
+
+    def __send_ready(self) -> None:
+        with self.__lock:
+            batch = self.__ready[:self.__batch_size]
+            del self.__ready[:len(batch)]
+        try:
+            _send_drafts(self.__gmail, self.__journal, batch)
+        except Exception as exc:
+            _fail_undelivered(self.__journal, batch, exc)
+
+    def close(self) -> None:
+        self.__executor.shutdown()
+
+
+# Creates drafts for deliveries that do not have one yet (from an earlier
+# run), then sends them all if --send was given, journaling every outcome.
+# With `held`, sending is left to it, to wait for each party's envelope.
+def _deliver_batch(args: Arguments,
+                   gmail: GmailService,
+                   journal: MailingJournal,
+                   held: Optional[_HeldSends],
+                   deliveries: List[_Delivery]) -> None:
+    to_create = [delivery for delivery in deliveries if delivery.draft is None]
+    drafts    = _single_or_batch(
+        gmail.create_draft,
+        gmail.create_drafts,
+        [delivery.message for delivery in to_create]
     )
 
-    upload_envelopes(
-        args.envelopes_dir,
-        args.resource_bucket,
-        args.envelope_prefix,
-        parties
+    created = [delivery for delivery in deliveries if delivery.draft is not None]
+    for delivery, result in zip(to_create, drafts):
+        party = delivery.party
+        if result.error is not None:
+            print(f'Unable to create draft for party {party.id} ({party.title}): {result.error}')
+            metrics.count('drafts_failed')
+            journal.record(party.id, delivery.guest_id, FAILED, error = str(result.error))
+            delivery.delivered.set_result(False)
+        else:
+            metrics.count('drafts_created')
+            journal.record(party.id, delivery.guest_id, DRAFTED, draft_id = result.response['id'])
+            created.append(delivery._replace(draft = result.response))
+
+    if not args.send:
+        for delivery in created:
+            delivery.delivered.set_result(True)
+    elif held is not None:
+        held.add(created)
+    else:
+        _send_drafts(gmail, journal, created)
+
+
+# Fails every delivery of a batch that raised before it was resolved.
+def _fail_undelivered(journal: MailingJournal,
+                      batch: List[_Delivery],
+                      exc: Exception) -> None:
+    for delivery in batch:
+        if delivery.delivered.done():
+            continue
+        party = delivery.party
+        if delivery.draft is None:
+            print(f'Unable to create draft for party {party.id} ({party.title}): {exc}')
+            metrics.count('drafts_failed')
+            journal.record(party.id, delivery.guest_id, FAILED, error = str(exc))
+        else:
+            print(f'Unable to send email for party {party.id} ({party.title}): {exc}')
+            metrics.count('emails_failed')
+            journal.record(party.id, delivery.guest_id, FAILED, draft_id = delivery.draft['id'], error = str(exc))
+        delivery.delivered.set_result(False)
+
+
+# `slots`, when given, is released for every delivery of the batch once its
+# draft is created (or has failed).
+def _submit_batch(executor: ThreadPoolExecutor,
+                  args: Arguments,
+                  gmail: GmailService,
+                  journal: MailingJournal,
+                  held: Optional[_HeldSends],
+                  pending: List[_Delivery],
+                  slots: Optional[threading.Semaphore] = None) -> None:
+    def deliver(batch):
+        try:
+            _deliver_batch(args, gmail, journal, held, batch)
+        except Exception as exc:
+            _fail_undelivered(journal, batch, exc)
+        finally:
+            if slots is not None:
+                for _ in batch:
+                    slots.release()
+
+    if pending:
+        executor.submit(deliver, list(pending))
+        pending.clear()
+
+
+def _finish_party(updater: Optional['RsvpStageUpdater'],
+                  party: Party,
+                  deliveries: List[Future]) -> None:
+    if not all(delivery.result() for delivery in deliveries):
+        print(f'Not setting party {party.id} ({party.title}) rsvp stage because some invitations failed')
+        return
+    if updater is not None:
+        updater.update(party)
+
+
+# Parties are marked as emailed by updating only their rsvp stage in the
+# table. Runs working from a snapshot without a table do not mark them.
+def _stage_updater(args: Arguments) -> Optional['RsvpStageUpdater']:
+    if args.parties_table is None:
+        return None
+
+    from invites.aws import RsvpStageUpdater
+
+    return RsvpStageUpdater(
+        args.parties_table,
+        EmailSent,
+        limiter = option.fmap(TokenBucket)(args.dynamodb_write_rate)
     )
 
 
+def _completed(args: Arguments, entry: Optional[dict]) -> bool:
+    return entry is not None and (
+        entry['state'] == SENT or
+        entry['state'] == DRAFTED and not args.send
+    )
+
+
+# Which guests a run works on: everyone normally, everyone not yet done with
+# --resume, and only guests whose last attempt failed with --retry-failed.
+def _wanted(args: Arguments, entry: Optional[dict]) -> bool:
+    if args.retry_failed:
+        return entry is not None and not _completed(args, entry)
+    if args.resume:
+        return not _completed(args, entry)
+    return True
+
+
+def _resolved_delivery(delivered: bool) -> Future:
+    future = Future()  # type: Future
+    future.set_result(delivered)
+    return future
+
+
 def _create_emails(args: Arguments,
-                   parties: Store[str, Party],
-                   gmail: GmailService):
-    senders_parties = filter(
-        lambda party: party.inviter == args.sender,
-        parties.get_all() if len(args.only) == 0 else map(parties.get, args.only)
+                   sender: _Sender,
+                   updater: Optional['RsvpStageUpdater'],
+                   journal: MailingJournal,
+                   barrier: Optional[EnvelopeBarrier] = None,
+                   cancelled: Optional[threading.Event] = None):
+    gmail = sender.gmail
+
+    render_invitations = InvitationRenderer(
+        args.invitation_url,
+        args.html_template,
+        args.envelope_url_template
     )
+    build_message = render.MessageBuilder(sender.address)
+    resuming      = args.resume or args.retry_failed
 
-    for party in senders_parties:
-        party_invitations = build_invitations(
-            args.invitation_url,
-            args.html_template,
-            args.envelope_url_template,
-            party
-        )
+    # Keep at most this many invitations waiting for their drafts, so
+    # rendering does not run far ahead of Gmail. Invitations whose drafts
+    # wait for their envelope to be sent do not count.
+    slots = threading.Semaphore(args.concurrency * args.batch_size)
+    held  = _HeldSends(args, gmail, journal, barrier) if barrier is not None and args.send else None
+
+    with ThreadPoolExecutor(max_workers = args.concurrency) as executor:
+        in_flight = deque()  # type: Deque[Tuple[Party, List[Future]]]
+        pending   = []       # type: List[_Delivery]
+
+        # Parties are finished (and marked as emailed) in order, as soon as
+        # all their invitations are, while later ones are still rendering.
+        def finish_delivered():
+            while in_flight and all(delivered.done() for delivered in in_flight[0][1]):
+                _finish_party(updater, *in_flight.popleft())
+
+        for party in sender.parties:
+            if cancelled is not None and cancelled.is_set():
+                print(f'Stopped before party {party.id} ({party.title}) because the run was cancelled')
+                break
 
-        for invitation in party_invitations:
-            try:
-                draft = gmail.create_draft(render.base64_email(args.sender, invitation))
-            except Exception as exc:
-                print(f'Unable to create draft for party {party.id} ({party.title}): {exc}')
-                traceback.print_exc()
-                continue
-
-            if args.send:
-                try:
-                    gmail.send(draft)
-                except Exception as e:
-                    print(f'Unable to send email for party {party.id} ({party.title}): {e}')
+            with metrics.stage('render_invitations'):
+                party_invitations = render_invitations(party)
+            metrics.count('invitations_rendered', len(party_invitations))
+
+            deliveries = []
+            worked_on  = False
+            for invitation in party_invitations:
+                entry = journal.entry(party.id, invitation.guest_id) if resuming else None
+
+                if not _wanted(args, entry):
+                    metrics.count('invitations_skipped')
+                    deliveries.append(_resolved_delivery(_completed(args, entry)))
                     continue
 
+                worked_on = True
+                delivered = Future()  # type: Future
+                deliveries.append(delivered)
+                slots.acquire()
+                if entry is not None and entry['draft'] is not None:
+                    pending.append(_Delivery(party, invitation.guest_id, None, { 'id': entry['draft'] }, delivered))
+                else:
+                    with metrics.stage('build_messages'):
+                        message = build_message(invitation)
+                    pending.append(_Delivery(party, invitation.guest_id, message, None, delivered))
+                if len(pending) >= args.batch_size:
+                    _submit_batch(executor, args, gmail, journal, held, pending, slots)
+
+            # A party whose guests were all done by earlier runs is still
+            # marked, in case the run that finished it was interrupted first.
+            if worked_on or all(delivered.result() for delivered in deliveries):
+                in_flight.append((party, deliveries))
+            finish_delivered()
+
         try:
-            parties.modify(
-                party.id,
-                lambda p: p._replace(rsvp_stage = EmailSent)
-            )
-        except Exception as exc:
-            print(f'Unable to set party {party.id} ({party.title}) rsvp stage: {exc}')
+            _submit_batch(executor, args, gmail, journal, held, pending, slots)
+            for party, deliveries in in_flight:
+                _finish_party(updater, party, deliveries)
+        finally:
+            if held is not None:
+                held.close()
+
+
+# Finds each guest's draft among the drafts in the mailbox by its guest
+# header, or, for invitation drafts without one (by their subject), by
+# recipient when no other guest shares the address. Other drafts to a guest,
+# such as the inviter's own, are never sent.
+def _existing_drafts(gmail: GmailService,
+                     guests: List[Guest]) -> Dict[str, dict]:
+    with metrics.stage('list_drafts'):
+        listed = gmail.list_drafts()
+        read   = gmail.get_drafts([draft['id'] for draft in listed])
+    metrics.count('drafts_listed', len(listed))
+
+    guest_ids  = { guest.id for guest in guests }
+    addresses  = Counter(render.email_address(guest.email).lower() for guest in guests)
+    by_address = { render.email_address(guest.email).lower(): guest.id for guest in guests }
+
+    drafts = {}  # type: Dict[str, dict]
+    for draft, result in zip(listed, read):
+        if result.error is not None:
+            print(f'Unable to read draft {draft["id"]}: {result.error}')
+            continue
 
+        headers = draft_headers(result.response)
+        if render.GUEST_HEADER.lower() in headers:
+            guest_id = headers[render.GUEST_HEADER.lower()]
+        elif headers.get('subject') == INVITATION_SUBJECT:
+            address  = parseaddr(headers.get('to', ''))[1].lower()
+            guest_id = by_address.get(address) if addresses[address] == 1 else None
+        else:
+            continue
 
+        if guest_id not in guest_ids:
+            continue
+        if guest_id in drafts:
+            print(f'Found more than one draft for guest {guest_id}; only sending draft {drafts[guest_id]["id"]}')
+            continue
+        drafts[guest_id] = { 'id': draft['id'] }
+
+    return drafts
+
+
+# Sends the drafts an earlier run left in the mailbox, in batches, without
+# rendering anything. Guests the journal records as sent are skipped, and a
+# party is only marked as emailed once every guest's invitation is sent.
+def _send_existing(args: Arguments,
+                   sender: _Sender,
+                   updater: Optional['RsvpStageUpdater'],
+                   journal: MailingJournal,
+                   barrier: Optional[EnvelopeBarrier] = None,
+                   cancelled: Optional[threading.Event] = None):
+    gmail  = sender.gmail
+    drafts = _existing_drafts(gmail, [
+        guest
+        for party in sender.parties
+        for guest in party.guests
+        if guest.email is not None
+    ])
+
+    held = _HeldSends(args, gmail, journal, barrier) if barrier is not None and args.send else None
+
+    with ThreadPoolExecutor(max_workers = args.concurrency) as executor:
+        in_flight = []  # type: List[Tuple[Party, List[Future]]]
+        pending   = []  # type: List[_Delivery]
+
+        for party in sender.parties:
+            if cancelled is not None and cancelled.is_set():
+                print(f'Stopped before party {party.id} ({party.title}) because the run was cancelled')
+                break
+
+            deliveries = []
+            worked_on  = False
+            for guest in party.guests:
+                if guest.email is None:
+                    continue
+
+                entry = journal.entry(party.id, guest.id)
+                if entry is not None and entry['state'] == SENT:
+                    metrics.count('invitations_skipped')
+                    deliveries.append(_resolved_delivery(True))
+                    continue
+
+                draft = drafts.get(guest.id)
+                if draft is None:
+                    print(f'No draft found for guest {guest.id} of party {party.id} ({party.title})')
+                    metrics.count('drafts_missing')
+                    deliveries.append(_resolved_delivery(False))
+                    continue
+
+                worked_on = True
+                delivered = Future()  # type: Future
+                deliveries.append(delivered)
+                pending.append(_Delivery(party, guest.id, None, draft, delivered))
+                if len(pending) >= args.batch_size:
+                    _submit_batch(executor, args, gmail, journal, held, pending)
+
+            # A party whose guests were all done by earlier runs is still
+            # marked, in case the run that finished it was interrupted first.
+            if worked_on or all(delivered.result() for delivered in deliveries):
+                in_flight.append((party, deliveries))
+
+        try:
+            _submit_batch(executor, args, gmail, journal, held, pending)
+            for party, deliveries in in_flight:
+                _finish_party(updater, party, deliveries)
+        finally:
+            if held is not None:
+                held.close()
+
+
+# Emails only link to where each envelope will be uploaded, so drafting does
+# not wait for envelopes and the two stages run side by side. With
+# --wait-for-envelopes, sending a party's invitations waits for its envelope
+# upload; with --sequential, emails start once every envelope is done.
+# Every sender's emails are a stage of their own, so with --all-senders the
+# run takes as long as the slowest sender rather than all of them in turn.
 def main(args: Arguments,
          parties: Store[str, Party],
-         gmail: GmailService):
+         senders: List[_Sender]) -> bool:
+    barrier = (
+        EnvelopeBarrier()
+        if args.wait_for_envelopes and not args.skip_envelopes and senders else
+        None
+    )
+    cancelled = threading.Event()
+    journal   = MailingJournal(args.journal) if senders else None
+    updater   = _stage_updater(args) if senders else None
+    mail      = _send_existing if args.send_existing else _create_emails
 
+    stages = []
     if not args.skip_envelopes:
-        _create_envelopes(args, parties)
+        stages.append(stage(
+            'envelopes',
+            lambda: _create_envelopes(args, parties, barrier)
+        ))
+    for sender in senders:
+        stages.append(stage(
+            f'emails:{render.email_address(sender.address)}' if args.all_senders else 'emails',
+            partial(mail, args, sender, updater, journal, barrier, cancelled),
+            after = ['envelopes'] if args.sequential and not args.skip_envelopes else []
+        ))
 
-    if not args.skip_email:
-        _create_emails(args, parties, gmail)
+    try:
+        results = run_stages(stages, cancelled)
+    finally:
+        if updater is not None:
+            updater.close()
+        if journal is not None:
+            journal.close()
+    return all(result.error is None and not result.skipped for result in results)
 
 
 if __name__ == '__main__':
     args = parse_arguments()
+    metrics.add_stage('startup', time.perf_counter() - _STARTED)
 
     if args.send and not args.skip_email:
         answer = input("Are you sure you are ready to send invitations? (y/n): ")
         if answer.lower() != "y":
             sys.exit(0)
 
-    parties = party_store(boto3.resource('dynamodb').Table(args.parties_table))
+    def run():
+        parties = PartySnapshot(_party_source(args))
+        senders = []  # type: List[_Sender]
 
-    if not args.skip_envelopes:
-        _create_envelopes(args, parties)
-    else:
-        print("Skipping envelope creation because --skip-envelopes specified")
+        if args.skip_envelopes:
+            print("Skipping envelope creation because --skip-envelopes specified")
 
-    if not args.skip_email:
-        google_creds = get_credentials(
-            args.client_secret_file,
-            args.token_storage_file,
-            render.email_address(args.sender)
-        )
-        _create_emails(
-            args,
-            parties,
-            gmail_service(google_creds, args.sender)
-        )
-    else:
-        print("Skipping email creation and sending because --skip-email specified")
+        if not args.skip_email:
+            # Asked for one at a time, since a sender without a stored token
+            # is prompted for an authorization code.
+            for address, senders_parties in _parties_by_sender(args, parties).items():
+                with metrics.stage('credentials'):
+                    google_creds = get_credentials(
+                        args.client_secret_file,
+                        args.token_storage_file,
+                        render.email_address(address)
+                    )
+                senders.append(_Sender(
+                    address,
+                    senders_parties,
+                    thread_local_gmail_service(google_creds, address, args.discovery_cache_file, args.gmail_quota)
+                ))
+        else:
+            print("Skipping email creation and sending because --skip-email specified")
+
+        if not main(args, parties, senders):
+            sys.exit(1)
+
+    instrumented(
+        run,
+        'mailing',
+        metrics_file   = args.metrics_file,
+        metrics_format = args.metrics_format,
+        profile_file   = args.profile
+    )
@@ -0,0 +1,34 @@
+from contextlib import contextmanager
+
+import boto3
+import pytest
+
+try:
+    from moto import mock_aws
+except ImportError:
+    # moto before 5.0 mocks every service separately.
+    from moto import mock_dynamodb2, mock_s3
+
+    @contextmanager
+    def mock_aws():
+        with mock_dynamodb2(), mock_s3():
+            yield
+
+
+@pytest.fixture
+def aws(monkeypatch):
+    monkeypatch.setenv('AWS_ACCESS_KEY_ID', 'testing')
+    monkeypatch.setenv('AWS_SECRET_ACCESS_KEY', 'testing')
+    monkeypatch.setenv('AWS_DEFAULT_REGION', 'us-east-1')
+    with mock_aws():
+        yield
+
+
+@pytest.fixture
+def table(aws):
+    return boto3.resource('dynamodb').create_table(
+        TableName             = 'parties',
+        KeySchema             = [{ 'AttributeName': 'id', 'KeyType': 'HASH' }],
+        AttributeDefinitions  = [{ 'AttributeName': 'id', 'AttributeType': 'S' }],
+        ProvisionedThroughput = { 'ReadCapacityUnits': 5, 'WriteCapacityUnits': 5 }
+    )
@@ -0,0 +1,195 @@
+import os
+import string
+
+import boto3
+import pytest
+from botocore.exceptions import ClientError
+
+from wedding.model import EmailSent, PartyCodec
+
+from benchmark import synthetic_parties
+from invites.aws import RsvpStageUpdater, rsvp_stage_attribute, upload_envelopes, write_parties
+
+BUCKET = 'resources'
+PREFIX = 'envelopes'
+
+
+def _stored_ids(table) -> set:
+    return { item['id'] for item in table.scan()['Items'] }
+
+
+def test_write_parties_puts_every_batch(table):
+    parties = synthetic_parties(200)
+
+    failures = write_parties(table.name, parties, writers = 4)
+
+    assert failures == []
+    assert _stored_ids(table) == { party.id for party in parties }
+
+
+def test_write_parties_deletes(table):
+    parties = synthetic_parties(100)
+    write_parties(table.name, parties)
+
+    failures = write_parties(table.name, [], deletes = parties[:30])
+
+    assert failures == []
+    assert _stored_ids(table) == { party.id for party in parties[30:] }
+
+
+# A DynamoDB resource whose batch writes all fail, as they would on a missing
+# table (older moto releases silently drop those writes instead).
+class _RejectingDynamoDB:
+    @staticmethod
+    def batch_write_item(**kwargs):
+        raise ClientError(
+            { 'Error': { 'Code': 'ResourceNotFoundException', 'Message': 'Requested resource not found' } },
+            'BatchWriteItem'
+        )
+
+
+def test_write_parties_reports_failed_parties(monkeypatch):
+    parties = synthetic_parties(40)
+    monkeypatch.setattr('invites.aws._thread_dynamodb', _RejectingDynamoDB)
+
+    failures = write_parties('missing', parties)
+
+    assert sorted(party.id for party, _ in failures) == sorted(party.id for party in parties)
+
+
+def test_rsvp_stage_updater_sets_only_the_stage(table):
+    parties   = synthetic_parties(40)
+    attribute = rsvp_stage_attribute(parties[0], EmailSent)
+    write_parties(table.name, parties)
+
+    # One party was emailed already.
+    emailed = parties[0]._replace(rsvp_stage = EmailSent)
+
+    updater = RsvpStageUpdater(table.name, EmailSent)
+    for party in [emailed] + parties[1:]:
+        updater.update(party)
+    results = updater.close()
+
+    assert all(result.error is None and not result.changed for result in results)
+
+    items = { item['id']: item for item in table.scan()['Items'] }
+    assert items[emailed.id][attribute] == PartyCodec.encode(parties[0])[attribute]
+    assert all(items[party.id] == PartyCodec.encode(party._replace(rsvp_stage = EmailSent)) for party in parties[1:])
+
+
+# A party table that refuses to update the parties in responded, as if their
+# guests had responded since they were read, and records every update made.
+class _RespondedTable:
+    def __init__(self, responded) -> None:
+        self.__responded = responded
+        self.updates     = []
+
+    def Table(self, name):
+        return self
+
+    def update_item(self, **kwargs) -> None:
+        self.updates.append(kwargs)
+        if kwargs['Key']['id'] in self.__responded:
+            raise ClientError(
+                { 'Error': { 'Code': 'ConditionalCheckFailedException', 'Message': 'The conditional request failed' } },
+                'UpdateItem'
+            )
+
+
+# Conditions on the stage read are evaluated by DynamoDB itself, since the
+# moto releases that work with the pinned boto3 apply them unconditionally.
+def test_rsvp_stage_updater_leaves_stages_that_changed_alone(monkeypatch):
+    parties   = synthetic_parties(10)
+    attribute = rsvp_stage_attribute(parties[0], EmailSent)
+    responded = parties[0]
+    table     = _RespondedTable({ responded.id })
+    monkeypatch.setattr('invites.aws._thread_dynamodb', lambda: table)
+
+    updater = RsvpStageUpdater('parties', EmailSent)
+    for party in parties:
+        updater.update(party)
+    results = { result.party.id: result for result in updater.close() }
+
+    assert all(result.error is None for result in results.values())
+    assert results[responded.id].changed
+    assert not any(result.changed for party_id, result in results.items() if party_id != responded.id)
+    assert all(
+        update['ConditionExpression'] == '#stage = :expected' and
+        update['ExpressionAttributeNames'] == { '#stage': attribute } and
+        update['ExpressionAttributeValues'][':expected'] == PartyCodec.encode(parties[0])[attribute]
+        for update in table.updates
+    )
+
+
+# A codec that also keeps the stage's name in a second attribute.
+class _DoubleStageCodec:
+    @staticmethod
+    def encode(party) -> dict:
+        encoded = PartyCodec.encode(party)
+        return dict(encoded, stageName = repr(party.rsvp_stage))
+
+
+def test_rsvp_stage_attribute_must_be_one_attribute(monkeypatch):
+    party = synthetic_parties(1)[0]
+    monkeypatch.setattr('invites.aws.PartyCodec', _DoubleStageCodec)
+
+    with pytest.raises(ValueError):
+        rsvp_stage_attribute(party, EmailSent)
+    with pytest.raises(ValueError):
+        rsvp_stage_attribute(party, party.rsvp_stage)
+
+
+# Only what the uploader reads: parties by id.
+class DictStore:
+    def __init__(self, parties) -> None:
+        self.__parties = { party.id: party for party in parties }
+
+    def get(self, key):
+        return self.__parties.get(key)
+
+
+@pytest.fixture
+def bucket(aws):
+    boto3.client('s3').create_bucket(Bucket = BUCKET)
+    return BUCKET
+
+
+def _write_envelopes(envelope_dir, parties):
+    for index, party in enumerate(parties):
+        with open(os.path.join(envelope_dir, f'{party.id}.png'), 'wb') as fout:
+            fout.write(f'envelope {index}'.encode('ascii'))
+
+
+def _tags(key: str) -> dict:
+    return {
+        tag['Key']: tag['Value']
+        for tag in boto3.client('s3').get_object_tagging(Bucket = BUCKET, Key = key)['TagSet']
+    }
+
+
+def test_upload_envelopes_uploads_and_tags_every_envelope(bucket, tmpdir):
+    parties = synthetic_parties(40)
+    _write_envelopes(str(tmpdir), parties)
+
+    results = upload_envelopes(str(tmpdir), bucket, PREFIX, DictStore(parties), workers = 4)
+
+    assert all(result.error is None and not result.skipped for result in results)
+    assert len(results) == len(parties)
+    for party in parties:
+        key  = f'{PREFIX}/{party.id}.png'
+        body = boto3.client('s3').get_object(Bucket = BUCKET, Key = key)['Body'].read()
+        assert body.startswith(b'envelope ')
+        assert _tags(key) == { 'party': ''.join(c for c in party.title if c in string.ascii_letters) }
+
+
+def test_upload_envelopes_skips_unchanged_envelopes(bucket, tmpdir):
+    parties = synthetic_parties(20)
+    _write_envelopes(str(tmpdir), parties)
+    upload_envelopes(str(tmpdir), bucket, PREFIX, DictStore(parties))
+
+    with open(os.path.join(str(tmpdir), f'{parties[0].id}.png'), 'wb') as fout:
+        fout.write(b'changed')
+    results = upload_envelopes(str(tmpdir), bucket, PREFIX, DictStore(parties))
+
+    uploaded = [result.filename for result in results if not result.skipped]
+    assert uploaded == [os.path.join(str(tmpdir), f'{parties[0].id}.png')]
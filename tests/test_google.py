@@ -0,0 +1,214 @@
+import json
+import os
+import re
+
+from googleapiclient import discovery
+from googleapiclient.errors import HttpError
+from httplib2 import Response
+
+from invites.google import GmailService, _gmail_retry_after
+from invites.ratelimit import Backoff, Clock
+
+
+class FakeClock(Clock):
+    def __init__(self) -> None:
+        self.time  = 0.0
+        self.slept = []
+
+    def now(self) -> float:
+        return self.time
+
+    def sleep(self, seconds: float) -> None:
+        self.slept.append(seconds)
+        self.time += seconds
+
+
+# Records the body of every request, so tests can see which calls each batch
+# carried, and answers each with the next of responses: its headers, and a
+# function making its body from the request's.
+class RecordingHttp:
+    def __init__(self, responses) -> None:
+        self.__responses = list(responses)
+        self.bodies      = []
+
+    def request(self, uri, method = 'GET', body = None, headers = None, *args, **kwargs):
+        self.bodies.append(body)
+        response_headers, respond = self.__responses.pop(0)
+        return Response(response_headers), respond(body).encode('utf-8')
+
+
+# A batch reply with a part per (request id, status, content). Like Google's,
+# it names each part by the Content-ID of its request with "response-" in
+# front, whichever way the client library wrote those.
+def _batch_response(parts):
+    def respond(request_body: str) -> str:
+        content_ids = {
+            content_id.rsplit('+', 1)[1].strip(): content_id
+            for content_id in re.findall(r'^Content-ID: <(.*)>', request_body, re.MULTILINE)
+        }
+        return ''.join(
+            f'--batch\r\n'
+            f'Content-Type: application/http\r\n'
+            f'Content-ID: <response-{content_ids[request_id]}>\r\n\r\n'
+            f'HTTP/1.1 {status} Status\r\n'
+            f'Content-Type: application/json\r\n\r\n'
+            f'{content}\r\n'
+            for request_id, status, content in parts
+        ) + '--batch--'
+    return ({ 'status': '200', 'content-type': 'multipart/mixed; boundary=batch' }, respond)
+
+
+# Just the parts of Gmail's discovery document the tests call, so no network
+# access (or a particular client library version's bundled copy) is needed.
+_DISCOVERY_FILE = os.path.join(os.path.dirname(__file__), 'gmail_discovery.json')
+
+
+def _gmail(http, clock: FakeClock) -> GmailService:
+    with open(_DISCOVERY_FILE, 'r') as fin:
+        service = discovery.build_from_document(fin.read(), http = http)
+    return GmailService(
+        service,
+        'me',
+        backoff = Backoff(clock = clock, jitter = lambda low, high: high)
+    )
+
+
+# An error body as Google's APIs send it: the reasons are only in `errors`,
+# the message is for people.
+def _error(code: int, reason: str, message: str) -> str:
+    return json.dumps({
+        'error': {
+            'errors' : [{ 'domain': 'usageLimits', 'reason': reason, 'message': message }],
+            'code'   : code,
+            'message': message
+        }
+    })
+
+
+def _rate_limited() -> str:
+    return _error(429, 'rateLimitExceeded', 'Rate Limit Exceeded')
+
+
+def test_batch_results_follow_input_order():
+    http  = RecordingHttp([_batch_response([
+        ('1', 200, json.dumps({ 'id': 'second' })),
+        ('0', 200, json.dumps({ 'id': 'first' }))
+    ])])
+    clock = FakeClock()
+
+    results = _gmail(http, clock).create_drafts(['first message', 'second message'])
+
+    assert [result.response['id'] for result in results] == ['first', 'second']
+    assert all(result.error is None for result in results)
+    assert len(http.bodies) == 1
+    assert clock.slept == []
+
+
+def test_only_throttled_calls_are_retried():
+    http  = RecordingHttp([
+        _batch_response([
+            ('0', 200, json.dumps({ 'id': 'sent' })),
+            ('1', 429, _rate_limited())
+        ]),
+        _batch_response([
+            ('1', 200, json.dumps({ 'id': 'retried' }))
+        ])
+    ])
+    clock = FakeClock()
+
+    results = _gmail(http, clock).send_drafts([{ 'id': 'a' }, { 'id': 'b' }])
+
+    assert [result.response['id'] for result in results] == ['sent', 'retried']
+    assert len(http.bodies) == 2
+    assert '"id": "a"' not in http.bodies[1] and '"id": "b"' in http.bodies[1]
+    assert clock.slept == [0.5]
+
+
+def test_user_rate_limit_403s_are_retried():
+    http  = RecordingHttp([
+        _batch_response([
+            ('0', 403, _error(403, 'userRateLimitExceeded', 'User-rate limit exceeded')),
+            ('1', 403, _error(403, 'insufficientPermissions', 'Insufficient Permission'))
+        ]),
+        _batch_response([
+            ('0', 200, json.dumps({ 'id': 'retried' }))
+        ])
+    ])
+    clock = FakeClock()
+
+    results = _gmail(http, clock).send_drafts([{ 'id': 'a' }, { 'id': 'b' }])
+
+    assert results[0].response['id'] == 'retried'
+    assert isinstance(results[1].error, HttpError)
+    assert len(http.bodies) == 2
+    assert '"id": "a"' in http.bodies[1] and '"id": "b"' not in http.bodies[1]
+    assert clock.slept == [0.5]
+
+
+# google-api-python-client 1.6.5 leaves the reasons out of an HttpError's
+# message, so they have to be read from its body.
+class _MessageOnlyHttpError(HttpError):
+    def __str__(self) -> str:
+        return json.loads(self.content.decode('utf-8'))['error']['message']
+
+
+def test_rate_limit_reasons_are_read_from_the_error_body():
+    throttled = _MessageOnlyHttpError(
+        Response({ 'status': 403, 'retry-after': '3' }),
+        _error(403, 'userRateLimitExceeded', 'User-rate limit exceeded').encode('utf-8')
+    )
+    forbidden = _MessageOnlyHttpError(
+        Response({ 'status': 403 }),
+        _error(403, 'insufficientPermissions', 'Insufficient Permission').encode('utf-8')
+    )
+
+    assert _gmail_retry_after(throttled) == 3.0
+    assert _gmail_retry_after(forbidden) is None
+
+
+# A batch whose execute raises a rate limit error after some of its calls
+# have been reported, as a transport failing part way through would.
+class _InterruptedBatch:
+    executions = []
+
+    def __init__(self, callback) -> None:
+        self.__callback = callback
+        self.__requests = []
+
+    def add(self, request, request_id) -> None:
+        self.__requests.append((request, request_id))
+
+    def execute(self) -> None:
+        _InterruptedBatch.executions.append([request for request, _ in self.__requests])
+        request, request_id = self.__requests[0]
+        self.__callback(request_id, { 'id': request }, None)
+        if len(self.__requests) > 1:
+            raise HttpError(Response({ 'status': 429 }), _rate_limited().encode('utf-8'))
+        for request, request_id in self.__requests[1:]:
+            self.__callback(request_id, { 'id': request }, None)
+
+
+class _InterruptedService:
+    def users(self):
+        return self
+
+    def drafts(self):
+        return self
+
+    def send(self, userId, body):
+        return body['id']
+
+    def new_batch_http_request(self, callback):
+        return _InterruptedBatch(callback)
+
+
+def test_calls_reported_before_a_throttled_batch_are_not_sent_again():
+    _InterruptedBatch.executions = []
+    clock = FakeClock()
+    gmail = GmailService(_InterruptedService(), 'me', backoff = Backoff(clock = clock, jitter = lambda low, high: high))
+
+    results = gmail.send_drafts([{ 'id': 'a' }, { 'id': 'b' }])
+
+    assert [result.response['id'] for result in results] == ['a', 'b']
+    assert _InterruptedBatch.executions == [['a', 'b'], ['b']]
+    assert len(clock.slept) == 1
@@ -0,0 +1,60 @@
+import os
+
+from wedding.model import PartyCodec
+
+from benchmark import synthetic_parties, write_address_file
+from import_addresses import parse_parties, read_addresses, reimport_to_database, reuse_ids
+from invites.aws import write_parties
+
+
+def _reimport(table, existing, address_file) -> None:
+    titles = set()
+    errors = []
+    parties = reuse_ids(
+        { party.title: party for party in existing },
+        parse_parties(read_addresses(address_file, titles = titles), errors = errors)
+    )
+    reimport_to_database({ party.title: party for party in existing }, table.name, parties, titles)
+    assert errors == []
+
+
+def _stored_guest_ids(table) -> dict:
+    return {
+        item['id']: [guest['id'] for guest in item['guests']]
+        for item in table.scan()['Items']
+    }
+
+
+def test_reimporting_an_unchanged_file_changes_nothing(table, tmpdir, capsys):
+    parties      = synthetic_parties(100)
+    address_file = os.path.join(str(tmpdir), 'addresses.csv')
+    write_address_file(parties, address_file)
+    write_parties(table.name, parties)
+
+    _reimport(table, parties, address_file)
+
+    assert capsys.readouterr().out.startswith(f'0 added, 0 changed, 0 removed, {len(parties)} unchanged')
+    assert _stored_guest_ids(table) == { party.id: [guest.id for guest in party.guests] for party in parties }
+
+
+def _same_name_pair(party):
+    for index, guest in enumerate(party.guests):
+        for other in party.guests[index + 1:]:
+            if (guest.first_name, guest.last_name) == (other.first_name, other.last_name):
+                return guest, other
+    return None
+
+
+# Guests sharing a name keep their own IDs, even when listed the other way round.
+def test_reimport_matches_guests_sharing_a_name_by_email(table, tmpdir):
+    parties  = synthetic_parties(100)
+    repeated = next(party for party in parties if _same_name_pair(party) is not None)
+    write_parties(table.name, parties)
+
+    address_file = os.path.join(str(tmpdir), 'addresses.csv')
+    write_address_file([repeated._replace(guests = list(reversed(repeated.guests)))], address_file)
+
+    _reimport(table, [repeated], address_file)
+
+    stored = PartyCodec.decode(table.get_item(Key = { 'id': repeated.id })['Item'])
+    assert sorted(stored.guests) == sorted(repeated.guests)
@@ -0,0 +1,225 @@
+import base64
+import os
+import threading
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from benchmark import ENVELOPE_URL, INVITATION_URL, SENDER, synthetic_parties
+from invites.google import BatchResult
+from invites.journal import MailingJournal, FAILED, SENT
+from invites.stages import EnvelopeBarrier
+from invites.model import INVITATION_SUBJECT
+from invites.render import GUEST_HEADER, email_address
+from mailing import _Sender, _create_emails, _existing_drafts
+
+EMAIL_TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'resources', 'email_template.html')
+
+
+# Hands out draft ids and records every draft created and sent, from however
+# many threads. Drafts for the guests in fail_guests are rejected; every
+# message names its guest in a header.
+class FakeGmail:
+    def __init__(self, fail_guests = ()) -> None:
+        self.__lock        = threading.Lock()
+        self.__fail_guests = [guest_id.encode('ascii') for guest_id in fail_guests]
+        self.created       = []
+        self.sent          = []
+
+    def create_draft(self, message: str) -> dict:
+        decoded = base64.urlsafe_b64decode(message.encode('ascii'))
+        with self.__lock:
+            if any(guest_id in decoded for guest_id in self.__fail_guests):
+                raise RuntimeError('rejected')
+            self.created.append(message)
+            return { 'id': f'draft-{len(self.created)}' }
+
+    def send(self, draft: dict) -> dict:
+        with self.__lock:
+            self.sent.append(draft['id'])
+            return { 'id': draft['id'] }
+
+    def create_drafts(self, messages):
+        return [self.__result(self.create_draft, message) for message in messages]
+
+    def send_drafts(self, drafts):
+        return [self.__result(self.send, draft) for draft in drafts]
+
+    @staticmethod
+    def __result(call, item) -> BatchResult:
+        try:
+            return BatchResult(call(item), None)
+        except Exception as exc:
+            return BatchResult(None, exc)
+
+
+class RecordingUpdater:
+    def __init__(self) -> None:
+        self.updated = []
+
+    def update(self, party) -> None:
+        self.updated.append(party.id)
+
+
+@pytest.fixture(scope = 'module')
+def body_template() -> str:
+    with open(EMAIL_TEMPLATE, 'r') as fin:
+        return fin.read()
+
+
+def _args(body_template: str, **overrides) -> SimpleNamespace:
+    args = dict(
+        invitation_url        = INVITATION_URL,
+        html_template         = body_template,
+        envelope_url_template = ENVELOPE_URL,
+        send                  = True,
+        resume                = False,
+        retry_failed          = False,
+        concurrency           = 4,
+        batch_size            = 3
+    )
+    args.update(overrides)
+    return SimpleNamespace(**args)
+
+
+def _emailed(parties):
+    return [(party.id, guest.id) for party in parties for guest in party.guests if guest.email is not None]
+
+
+def test_create_emails_sends_every_invitation_once(body_template, tmpdir):
+    parties = synthetic_parties(60)
+    gmail   = FakeGmail()
+    updater = RecordingUpdater()
+    journal = MailingJournal(str(tmpdir.join('journal.jsonl')))
+
+    _create_emails(_args(body_template), _Sender(SENDER, parties, gmail), updater, journal)
+
+    emailed = _emailed(parties)
+    assert len(gmail.created) == len(emailed)
+    assert sorted(gmail.sent) == sorted(set(gmail.sent))
+    assert len(gmail.sent) == len(emailed)
+    assert all(journal.entry(party_id, guest_id)['state'] == SENT for party_id, guest_id in emailed)
+    assert sorted(updater.updated) == sorted(party.id for party in parties)
+
+
+def test_create_emails_leaves_parties_with_failed_drafts_unmarked(body_template, tmpdir):
+    parties = synthetic_parties(30)
+    failing = next(party for party in parties if any(guest.email is not None for guest in party.guests))
+    guests  = [guest.id for guest in failing.guests if guest.email is not None]
+    gmail   = FakeGmail(fail_guests = guests)
+    updater = RecordingUpdater()
+    journal = MailingJournal(str(tmpdir.join('journal.jsonl')))
+
+    _create_emails(_args(body_template), _Sender(SENDER, parties, gmail), updater, journal)
+
+    assert failing.id not in updater.updated
+    assert sorted(updater.updated) == sorted(party.id for party in parties if party.id != failing.id)
+    assert all(journal.entry(failing.id, guest_id)['state'] == FAILED for guest_id in guests)
+
+
+def test_resume_marks_parties_an_interrupted_run_finished(body_template, tmpdir):
+    parties      = synthetic_parties(30)
+    journal_file = str(tmpdir.join('journal.jsonl'))
+
+    # The run was interrupted after every invitation was sent, but before any
+    # party's rsvp stage was set.
+    journal = MailingJournal(journal_file)
+    for party_id, guest_id in _emailed(parties):
+        journal.record(party_id, guest_id, SENT, draft_id = 'sent-before')
+    journal.close()
+
+    gmail   = FakeGmail()
+    updater = RecordingUpdater()
+    _create_emails(
+        _args(body_template, resume = True),
+        _Sender(SENDER, parties, gmail),
+        updater,
+        MailingJournal(journal_file)
+    )
+
+    assert gmail.created == [] and gmail.sent == []
+    assert sorted(updater.updated) == sorted(party.id for party in parties)
+
+
+
+def _wait_for(condition, timeout: float = 10.0) -> None:
+    deadline = time.monotonic() + timeout
+    while not condition():
+        assert time.monotonic() < deadline
+        time.sleep(0.01)
+
+
+# Drafts are all created while sending waits for envelopes, even with a
+# single worker.
+def test_waiting_for_envelopes_holds_back_only_sending(body_template, tmpdir):
+    parties  = synthetic_parties(60)
+    held     = next(party for party in parties if any(guest.email is not None for guest in party.guests))
+    emailed  = _emailed(parties)
+    gmail    = FakeGmail()
+    updater  = RecordingUpdater()
+    barrier  = EnvelopeBarrier()
+    journal  = MailingJournal(str(tmpdir.join('journal.jsonl')))
+    mailing  = threading.Thread(target = lambda: _create_emails(
+        _args(body_template, concurrency = 1),
+        _Sender(SENDER, parties, gmail),
+        updater,
+        journal,
+        barrier
+    ), daemon = True)
+    mailing.start()
+
+    try:
+        _wait_for(lambda: len(gmail.created) == len(emailed))
+        assert gmail.sent == []
+
+        for party in parties:
+            if party.id != held.id:
+                barrier.uploaded(party.id)
+        _wait_for(lambda: len(gmail.sent) == len([guest for party_id, guest in emailed if party_id != held.id]))
+    finally:
+        barrier.close()
+    mailing.join(10)
+
+    assert not mailing.is_alive()
+    assert sorted(updater.updated) == sorted(party.id for party in parties if party.id != held.id)
+    assert all(journal.entry(held.id, guest.id)['state'] != SENT for guest in held.guests if guest.email is not None)
+
+
+# A mailbox of drafts, each given as its headers.
+class FakeMailbox:
+    def __init__(self, drafts) -> None:
+        self.__drafts = drafts
+
+    def list_drafts(self):
+        return [{ 'id': draft_id } for draft_id in self.__drafts]
+
+    def get_drafts(self, draft_ids):
+        return [
+            BatchResult({
+                'id'     : draft_id,
+                'message': { 'payload': { 'headers': [
+                    { 'name': name, 'value': value }
+                    for name, value in self.__drafts[draft_id].items()
+                ] } }
+            }, None)
+            for draft_id in draft_ids
+        ]
+
+
+def test_existing_drafts_without_a_guest_header_need_the_invitation_subject():
+    tagged, untagged, personal = [
+        guest
+        for party in synthetic_parties(30)
+        for guest in party.guests
+        if guest.email is not None
+    ][:3]
+    mailbox = FakeMailbox({
+        'tagged'  : { 'To': email_address(tagged.email), 'Subject': INVITATION_SUBJECT, GUEST_HEADER: tagged.id },
+        'untagged': { 'To': email_address(untagged.email), 'Subject': INVITATION_SUBJECT },
+        'personal': { 'To': email_address(personal.email), 'Subject': 'Dinner on Friday?' }
+    })
+
+    drafts = _existing_drafts(mailbox, [tagged, untagged, personal])
+
+    assert drafts == { tagged.id: { 'id': 'tagged' }, untagged.id: { 'id': 'untagged' } }
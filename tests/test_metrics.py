@@ -0,0 +1,25 @@
+import pstats
+
+from invites.metrics import instrumented
+from invites.stages import run_stages, stage
+
+
+def _busy() -> None:
+    sum(i * i for i in range(10000))
+
+
+def test_profile_covers_stages_on_their_own_threads(tmpdir):
+    profile_file = str(tmpdir.join('profile.out'))
+
+    instrumented(
+        lambda: run_stages([stage('first', _busy), stage('second', _busy)]),
+        'test',
+        profile_file = profile_file
+    )
+
+    calls = {
+        function: stats[1]
+        for (filename, line, function), stats in pstats.Stats(profile_file).stats.items()
+        if filename == __file__
+    }
+    assert calls['_busy'] == 2
@@ -0,0 +1,43 @@
+import os
+
+import pytest
+
+from benchmark import ENVELOPE_URL, INVITATION_URL, synthetic_parties
+from invites.model import InvitationRenderer, build_invitations
+
+EMAIL_TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'resources', 'email_template.html')
+
+# Titles that exercise HTML escaping, URL quoting and characters premailer
+# might treat differently from plain substitution.
+UNUSUAL_TITLES = [
+    'The Smith & Jones Family',
+    '<b>Bold</b> Family',
+    'The "Quoted" Family',
+    "The O'Brien Family",
+    'La Famille Garçon',
+    'The {{Mustache}} Family',
+    'Tab\tand space',
+    'Control \x07 Family'
+]
+
+
+@pytest.fixture(scope = 'module')
+def body_template() -> str:
+    with open(EMAIL_TEMPLATE, 'r') as fin:
+        return fin.read()
+
+
+def _parties():
+    parties = synthetic_parties(30)
+    return parties + [
+        party._replace(title = title)
+        for party, title in zip(synthetic_parties(len(UNUSUAL_TITLES) * 4, seed = 1), UNUSUAL_TITLES)
+    ]
+
+
+def test_renderer_matches_build_invitations(body_template):
+    render_invitations = InvitationRenderer(INVITATION_URL, body_template, ENVELOPE_URL)
+
+    for party in _parties():
+        expected = list(build_invitations(INVITATION_URL, body_template, ENVELOPE_URL, party))
+        assert render_invitations(party) == expected, party.title
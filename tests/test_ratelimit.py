@@ -0,0 +1,47 @@
+import pytest
+
+from invites.ratelimit import Backoff, TokenBucket, call_with_retries
+
+from tests.test_google import FakeClock
+
+
+def test_token_bucket_lets_a_burst_through_then_paces_calls():
+    clock  = FakeClock()
+    bucket = TokenBucket(10, clock = clock)
+
+    assert bucket.acquire(10) == 0.0
+    assert bucket.acquire(5) == 0.5
+    assert bucket.acquire(5) == 0.5
+    assert clock.slept == [0.5, 0.5]
+    assert clock.time == 1.0
+
+
+def test_token_bucket_refills_up_to_its_burst():
+    clock  = FakeClock()
+    bucket = TokenBucket(10, burst = 20, clock = clock)
+    bucket.acquire(20)
+
+    clock.time += 60
+
+    assert bucket.acquire(20) == 0.0
+    assert bucket.acquire(1) == 0.1
+
+
+def test_backoff_needs_an_attempt():
+    with pytest.raises(ValueError):
+        Backoff(max_attempts = 0)
+
+
+def test_call_with_retries_gives_up_after_max_attempts():
+    clock    = FakeClock()
+    attempts = []
+
+    def throttled():
+        attempts.append(clock.time)
+        raise RuntimeError('throttled')
+
+    with pytest.raises(RuntimeError):
+        call_with_retries(throttled, lambda exc: 0.0, backoff = Backoff(max_attempts = 3, clock = clock, jitter = lambda low, high: high))
+
+    assert len(attempts) == 3
+    assert clock.slept == [0.5, 1.0]
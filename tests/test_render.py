@@ -0,0 +1,52 @@
+import base64
+import os
+import re
+
+import pytest
+from wedding.model import EmailAddress
+
+from benchmark import ENVELOPE_URL, INVITATION_URL, SENDER, synthetic_parties
+from invites.model import Invitation, InvitationRenderer
+from invites.render import MessageBuilder, base64_email
+
+
+# base64_email picks a random MIME boundary for every message, and
+# MessageBuilder a fixed one per builder, so boundaries are compared apart.
+_BOUNDARY = re.compile(r'={15}\d+==')
+
+EMAIL_TEMPLATE = os.path.join(os.path.dirname(__file__), '..', 'resources', 'email_template.html')
+
+
+def _decoded(message: str) -> str:
+    return _BOUNDARY.sub('BOUNDARY', base64.urlsafe_b64decode(message).decode('utf-8'))
+
+
+def _invitation(recipient: EmailAddress = EmailAddress('guest', 'example.com'),
+                subject: str = 'Jenny and Jesse are Getting Married!',
+                message: str = '<p>Hello</p>',
+                guest_id: str = '4da5e709-d471-3d60-c8a7-0639eb1167b3') -> Invitation:
+    return Invitation(recipient, subject, message, guest_id)
+
+
+def test_rendered_invitations_match_base64_email():
+    with open(EMAIL_TEMPLATE, 'r') as fin:
+        render_invitations = InvitationRenderer(INVITATION_URL, fin.read(), ENVELOPE_URL)
+    build_message = MessageBuilder(SENDER)
+
+    for party in synthetic_parties(40):
+        for invitation in render_invitations(party):
+            assert _decoded(build_message(invitation)) == _decoded(base64_email(SENDER, invitation))
+
+
+@pytest.mark.parametrize('invitation', [
+    _invitation(message = 'Chloé & García'),
+    _invitation(message = 'line one\r\nline two'),
+    _invitation(message = 'looks like a boundary ===============0=='),
+    _invitation(subject = 'Ünïcode subject'),
+    _invitation(recipient = EmailAddress('chloé', 'example.com')),
+    _invitation(guest_id = 'guest\nid'),
+    _invitation(guest_id = 'gäst'),
+    _invitation(guest_id = 'x' * 100)
+])
+def test_unusual_invitations_match_base64_email(invitation):
+    assert _decoded(MessageBuilder(SENDER)(invitation)) == _decoded(base64_email(SENDER, invitation))
@@ -0,0 +1,51 @@
+import pytest
+from wedding.model import EmailSent
+
+from benchmark import synthetic_parties
+from invites.snapshot import PartySnapshot, SnapshotStore, write_snapshot
+
+
+# Only what the snapshot calls on the store it wraps, counting the scans.
+class DictStore:
+    def __init__(self, parties) -> None:
+        self.parties = { party.id: party for party in parties }
+        self.scans   = 0
+
+    def get_all(self):
+        self.scans += 1
+        return list(self.parties.values())
+
+    def get(self, key):
+        return self.parties.get(key)
+
+    def put(self, party) -> None:
+        self.parties[party.id] = party
+
+    def modify(self, key, modifier):
+        self.parties[key] = modifier(self.parties[key])
+
+
+def test_party_snapshot_writes_through_to_its_store():
+    parties = synthetic_parties(30)
+    store   = DictStore(parties)
+    cached  = PartySnapshot(store)
+    cached.get_all()
+
+    cached.modify(parties[0].id, lambda party: party._replace(rsvp_stage = EmailSent))
+
+    assert store.parties[parties[0].id].rsvp_stage is EmailSent
+    assert cached.get(parties[0].id).rsvp_stage is EmailSent
+    assert store.scans == 1
+
+
+def test_snapshot_store_refuses_writes(tmpdir):
+    parties       = synthetic_parties(30)
+    snapshot_file = str(tmpdir.join('parties.jsonl.gz'))
+    write_snapshot(snapshot_file, parties)
+    snapshot = SnapshotStore(snapshot_file)
+
+    assert snapshot.get(parties[3].id) == parties[3]
+    with pytest.raises(ValueError):
+        snapshot.modify(parties[3].id, lambda party: party._replace(rsvp_stage = EmailSent))
+    with pytest.raises(ValueError):
+        snapshot.put(parties[3])